@@ -1 +1,7 @@
 [puppet.deduktiva.com]
+# optional: fetch all facts with one query and one SSH session
+combined_query=yes
+# optional: query the PuppetDB HTTP API directly (e.g. a forwarded port) instead of ssh + curl
+#transport=http
+#url=http://localhost:8080
+#page_size=10000
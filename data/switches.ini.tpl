@@ -7,3 +7,23 @@ password=password
 device_type=cisco_nxos
 username=admin
 password=password
+# optional: timeouts in seconds, and number of retries (with backoff) if acquisition fails
+connect_timeout=10
+command_timeout=120
+retries=2
+# optional: acquire over NX-API (JSON-RPC over HTTPS, needs "feature nxapi") instead of SSH
+#transport=nxapi
+#nxapi_scheme=https
+#nxapi_port=443
+#verify_tls=no
+# optional for hp_comware with device_type_flavor=7: acquire over NETCONF (needs ncclient)
+#transport=netconf
+#netconf_port=830
+
+[old-procurve-sw01]
+device_type=hp_procurve
+username=admin
+password=password
+# acquire over SNMPv2c bulk walks instead of SSH (needs net-snmp's snmpbulkwalk)
+transport=snmp
+snmp_community=public
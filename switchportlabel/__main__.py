@@ -1,15 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from glob import glob
 from operator import itemgetter
+import argparse
 import configparser
 import itertools
 import os
 import shutil
 import sys
+import time
 
 from . import acquire_puppetdb
 from . import acquire_switches
+from . import compact
+from . import metrics
+from . import profiling
+from . import scope
+from .parallel import iter_parallel, run_parallel
 
 DATADIR_PUPPETDB = "data/puppetdb/"
 DATADIR_SWITCHES = "data/switches/"
+DATADIR_CACHE = "data/cache/"
+STATEFILE_CONFIGURE = "data/configure-state.json"
 
 
 def read_switch_device_options():
@@ -26,27 +38,126 @@ def read_switch_device_options():
     return devices
 
 
+def read_puppetdb_device_options():
+    device_parser = configparser.ConfigParser()
+    device_parser.read("data/puppetdb.ini")
+    return {device_name: dict(device_parser[device_name].items()) for device_name in device_parser.sections()}
+
+
 def clean_datadir(datadir):
     if os.path.exists(datadir):
         shutil.rmtree(datadir)
     os.makedirs(datadir)
 
 
-def do_acquire_switches():
+def prepare_datadir(datadir, ttl, filenames, scoped=False):
+    """
+    Without a ttl (and unless only some devices are acquired), start from an empty datadir. Otherwise keep
+    the existing snapshots, except those not in `filenames` (devices no longer configured).
+    """
+    if ttl is None and not scoped:
+        clean_datadir(datadir)
+        return
+    os.makedirs(datadir, exist_ok=True)
+    keep = {os.path.normpath(fn) for fn in filenames}
+    for fn in glob(os.path.join(datadir, "*")):
+        if os.path.normpath(fn) not in keep:
+            print("I: removing snapshot of unconfigured device", fn)
+            os.unlink(fn)
+
+
+def is_fresh(filenames, ttl):
+    """True if all files exist and were written less than `ttl` minutes ago."""
+    if ttl is None:
+        return False
+    now = time.time()
+    return all(os.path.exists(fn) and now - os.path.getmtime(fn) < ttl * 60 for fn in filenames)
+
+
+def select_stale(devices, filenames_for, ttl, refresh):
+    stale = {
+        device_name: device_options
+        for device_name, device_options in devices.items()
+        if device_name in refresh or not is_fresh(filenames_for(device_name), ttl)
+    }
+    if len(stale) < len(devices):
+        print("I: skipping", len(devices) - len(stale), "devices acquired less than", ttl, "minutes ago")
+    return stale
+
+
+def print_summary(results):
+    succeeded = [name for name, (_, exc) in results.items() if exc is None]
+    timed_out = [name for name, (_, exc) in results.items() if exc is not None and acquire_switches.is_timeout(exc)]
+    failed = [name for name, (_, exc) in results.items() if exc is not None and name not in timed_out]
+    print("Succeeded: %d, failed: %d, timed out: %d" % (len(succeeded), len(failed), len(timed_out)))
+    for name in failed:
+        print("E: failed:", name, results[name][1])
+    for name in timed_out:
+        print("E: timed out:", name, results[name][1])
+    return not failed and not timed_out
+
+
+def select_switches_to_acquire(devices, ttl, refresh, selectors, snapshot_format):
+    """Prepare the switch data directory, and return the devices to acquire."""
     datadir = DATADIR_SWITCHES
-    clean_datadir(datadir)
-    devices = read_switch_device_options()
-    for device_name, device_options in devices.items():
-        acquire_switches.acquire(device_name, device_options, datadir)
 
+    def filenames_for(device_name, snapshot_format=snapshot_format):
+        return acquire_switches.snapshot_filenames(datadir, device_name, snapshot_format)
 
-def do_acquire_puppetdb():
+    prepare_datadir(
+        datadir,
+        ttl,
+        [fn for device_name in devices for fmt in compact.FORMATS for fn in filenames_for(device_name, fmt)],
+        scoped=bool(selectors),
+    )
+    if selectors:
+        devices = {name: devices[name] for name in scope.select_switches(list(devices), selectors, devices)}
+    return select_stale(devices, filenames_for, ttl, refresh)
+
+
+def do_acquire_switches(workers, ttl, refresh, selectors, snapshot_format):
+    datadir = DATADIR_SWITCHES
+    devices = select_switches_to_acquire(read_switch_device_options(), ttl, refresh, selectors, snapshot_format)
+    results = run_parallel(
+        lambda device_name, device_options: acquire_switches.acquire_with_retries(
+            device_name, device_options, datadir, snapshot_format
+        ),
+        devices,
+        workers,
+    )
+    return print_summary(results)
+
+
+def do_acquire_puppetdb(ttl, refresh, snapshot_format):
     datadir = DATADIR_PUPPETDB
-    clean_datadir(datadir)
-    device_parser = configparser.ConfigParser()
-    device_parser.read("data/puppetdb.ini")
-    for device_name in device_parser.sections():
-        acquire_puppetdb.acquire(device_name, {}, datadir)
+    devices = read_puppetdb_device_options()
+
+    def filenames_for(device_name, snapshot_format=snapshot_format):
+        return [
+            acquire_puppetdb.snapshot_filename(datadir, device_name, fact_name, snapshot_format)
+            for fact_name in acquire_puppetdb.FACT_NAMES
+        ]
+
+    prepare_datadir(
+        datadir,
+        ttl,
+        [fn for device_name in devices for fmt in compact.FORMATS for fn in filenames_for(device_name, fmt)],
+    )
+    for device_name, device_options in select_stale(devices, filenames_for, ttl, refresh).items():
+        acquire_puppetdb.acquire(device_name, device_options, datadir, snapshot_format)
+
+
+def do_write_db(fn, cachedir):
+    from . import snapshot_db
+
+    switches = acquire_switches.read_switches(DATADIR_SWITCHES, cachedir)
+    snapshot_db.write_db(fn, switches, acquire_puppetdb.read_facts(DATADIR_PUPPETDB))
+    print("I: wrote", len(switches), "switches to", fn)
+
+
+def do_convert_snapshots(snapshot_format):
+    acquire_switches.convert_snapshots(DATADIR_SWITCHES, snapshot_format)
+    acquire_puppetdb.convert_snapshots(DATADIR_PUPPETDB, snapshot_format)
 
 
 def set_port_attr(switches, switchname, switchport, attr, value):
@@ -71,66 +182,333 @@ def format_description(switchport):
     return desc
 
 
-def do_configure(apply_changes):
-    from .configure import configure
+def render(switchname, switch):
+    """The configuration lines setting the new port descriptions of `switch`, empty if nothing changes."""
     from .configure_formatters import format_for
 
-    switch_device_options = read_switch_device_options() if apply_changes else None
+    with metrics.timed("format", device=switchname), profiling.phase("format"):
+        linesets = format_for(switch)
+    lines = []
+    for lineset in linesets or []:
+        lines.extend(lineset)
+    return lines
 
-    switches = acquire_switches.read_switches(DATADIR_SWITCHES)
 
-    hosts_fc = acquire_puppetdb.read_fibrechannel(DATADIR_PUPPETDB)
-    hosts_ipmi = acquire_puppetdb.read_ipmi(DATADIR_PUPPETDB)
-    hosts_lldp = acquire_puppetdb.read_lldp(DATADIR_PUPPETDB)
-    hosts_networking = acquire_puppetdb.read_networking(DATADIR_PUPPETDB)
+def configure_full(switches, hosts, options, selected=None, db=None, selected_hosts=None):
+    from .configure import configure
 
-    configure(switches, hosts_fc, hosts_ipmi, hosts_lldp, hosts_networking)
+    configure(
+        switches,
+        hosts["fibrechannel"],
+        hosts["ipmi"],
+        hosts["lldp"],
+        hosts["networking"],
+        columnar=options.columnar,
+        selected=selected,
+        selected_hosts=selected_hosts,
+        db=db,
+    )
+    return {
+        switchname: render(switchname, switch)
+        for switchname, switch in switches.items()
+        if selected is None or switchname in selected
+    }
+
+
+def do_configure(apply_changes, options):
+    switch_device_options = read_switch_device_options()
+
+    selected = None
+    if options.switch:
+        selected = set(scope.select_switches(list(switch_device_options), options.switch, switch_device_options))
+
+    db = None
+    if options.db:
+        from . import snapshot_db
+
+        db = snapshot_db.connect(options.db)
+        switches = snapshot_db.read_switches(db)
+        hosts = snapshot_db.read_facts(db)
+    else:
+        switches = acquire_switches.read_switches(
+            DATADIR_SWITCHES, None if options.no_cache else DATADIR_CACHE, options.parse_workers, selected
+        )
+        hosts = acquire_puppetdb.read_facts(DATADIR_PUPPETDB)
+    selected_hosts = None
+    if options.host:
+        selected_hosts = scope.select_hosts(hosts, options.host)
+
+    ok = True
+    if options.incremental or options.verify_incremental:
+        from . import incremental
+
+        rendered = incremental.configure_incremental(DATADIR_SWITCHES, switches, hosts, STATEFILE_CONFIGURE, render)
+        if options.verify_incremental:
+            full_switches = acquire_switches.read_switches(
+                DATADIR_SWITCHES, None if options.no_cache else DATADIR_CACHE, options.parse_workers
+            )
+            full_rendered = configure_full(full_switches, hosts, options)
+            ok = incremental.verify(rendered, full_rendered, STATEFILE_CONFIGURE)
+            if not ok:
+                # the incremental result was just shown to be wrong
+                rendered = full_rendered
+    else:
+        rendered = configure_full(switches, hosts, options, selected, db, selected_hosts)
 
-    for switchname, switch in switches.items():
-        linesets = format_for(switch)
-        if not linesets:
+    changes = {}
+    for switchname, lines in rendered.items():
+        if not lines:
             continue
 
-        print("--", switchname)
-        lines = []
-        for lineset in linesets:
-            lines.extend(lineset)
-
         if apply_changes:
-            acquire_switches.apply_config(switchname, switch_device_options[switchname], lines)
+            changes[switchname] = lines
         else:
+            print("--", switchname)
             print("\n".join(lines))
 
+    if not apply_changes or not ok:
+        return ok
+
+    results = run_parallel(partial(apply_config, switch_device_options), changes, options.workers)
+    print_apply_results(results)
+    return print_summary(results)
+
+
+def apply_config(switch_device_options, switchname, lines):
+    metrics.add("apply_lines", len(lines), device=switchname)
+    with metrics.timed("apply_device", device=switchname):
+        return acquire_switches.apply_config(switchname, switch_device_options[switchname], lines)
 
-def main(args):
-    action = args[1]
-    ok = False
+
+def print_apply_results(results):
+    for switchname, (output, exc) in results.items():
+        print("--", switchname)
+        print(output if exc is None else "E: %s" % exc)
+
+
+def do_acquire_configure(apply_changes, options):
+    """
+    Acquire PuppetDB, then acquire the switches and configure each one as soon as its inputs are in,
+    see pipeline. With apply_changes, each switch is changed as soon as it is rendered.
+    """
+    from . import pipeline
+
+    snapshot_format = options.snapshot_format or "text"
+    with metrics.timed("acquire_puppetdb"):
+        do_acquire_puppetdb(options.ttl, options.refresh, snapshot_format)
+    hosts = acquire_puppetdb.read_facts(DATADIR_PUPPETDB)
+
+    switch_device_options = read_switch_device_options()
+    stale = select_switches_to_acquire(switch_device_options, options.ttl, options.refresh, [], snapshot_format)
+
+    def acquire(device_name, device_options):
+        if device_name in stale:
+            acquire_switches.acquire_with_retries(device_name, device_options, DATADIR_SWITCHES, snapshot_format)
+
+    acquire_results = {}
+
+    def acquired():
+        # in the order switches are linked in, so the first ones can be rendered early
+        devices = {name: switch_device_options[name] for name in sorted(switch_device_options)}
+        for device_name, _, exc in iter_parallel(acquire, devices, options.workers):
+            acquire_results[device_name] = (None, exc)
+            if exc is not None:
+                print("E: acquiring", device_name, "failed:", exc)
+            yield device_name
+
+    started = time.time()
+    rendered = []
+    executor = ThreadPoolExecutor(max_workers=max(1, options.workers)) if apply_changes else None
+    applying = {}
+
+    def emit(switchname, lines):
+        if not rendered:
+            metrics.add("pipeline_first_render_seconds", time.time() - started)
+        rendered.append(switchname)
+        if not lines:
+            return
+        if not apply_changes:
+            # in one call, as acquisitions still running print from other threads
+            print("-- %s\n%s\n" % (switchname, "\n".join(lines)), end="")
+            return
+        if switchname in applying:
+            # rendered again after late LLDP data, apply once the first change is done
+            applying[switchname].exception()
+        applying[switchname] = executor.submit(apply_config, switch_device_options, switchname, lines)
+
+    pipeline.run(
+        sorted(switch_device_options),
+        acquired(),
+        DATADIR_SWITCHES,
+        None if options.no_cache else DATADIR_CACHE,
+        hosts,
+        render,
+        emit,
+    )
+    ok = print_summary({name: acquire_results[name] for name in sorted(switch_device_options)})
+    if not apply_changes:
+        return ok
+
+    executor.shutdown()
+    results = {}
+    for switchname, future in applying.items():
+        exc = future.exception()
+        results[switchname] = (None if exc else future.result(), exc)
+    print_apply_results(results)
+    return print_summary(results) and ok
+
+
+ACTIONS = [
+    "configure",
+    "configure-apply",
+    "acquire",
+    "acquire-puppetdb",
+    "acquire-switches",
+    "convert-snapshots",
+    "acquire-configure",
+    "acquire-configure-apply",
+]
+
+
+def run_action(options):
+    action = options.action
+    ok = True
 
     if action == "configure":
-        do_configure(False)
-        ok = True
+        with metrics.timed("configure"):
+            ok = do_configure(False, options) and ok
 
     if action == "configure-apply":
-        do_configure(True)
-        ok = True
+        with metrics.timed("configure"):
+            ok = do_configure(True, options) and ok
 
     if action in ("acquire", "acquire-puppetdb"):
-        do_acquire_puppetdb()
-        ok = True
+        with metrics.timed("acquire_puppetdb"):
+            do_acquire_puppetdb(options.ttl, options.refresh, options.snapshot_format or "text")
 
     if action in ("acquire", "acquire-switches"):
-        do_acquire_switches()
-        ok = True
+        with metrics.timed("acquire_switches"):
+            ok = (
+                do_acquire_switches(
+                    options.workers, options.ttl, options.refresh, options.switch, options.snapshot_format or "text"
+                )
+                and ok
+            )
+
+    if action in ("acquire", "acquire-puppetdb", "acquire-switches") and options.db:
+        with metrics.timed("write_db"):
+            do_write_db(options.db, None if options.no_cache else DATADIR_CACHE)
+
+    if action in ("acquire-configure", "acquire-configure-apply"):
+        with metrics.timed("acquire_configure"):
+            ok = do_acquire_configure(action == "acquire-configure-apply", options) and ok
+
+    if action == "convert-snapshots":
+        do_convert_snapshots(options.snapshot_format or "compact")
+
+    return ok
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=args[0])
+    parser.add_argument("action", choices=ACTIONS)
+    parser.add_argument(
+        "--workers", type=int, default=1, help="number of switches to talk to concurrently (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--ttl",
+        type=float,
+        help="keep existing data, and only acquire devices whose data is older than TTL minutes",
+    )
+    parser.add_argument(
+        "--refresh", action="append", default=[], metavar="DEVICE", help="always acquire DEVICE, even with --ttl"
+    )
+    parser.add_argument(
+        "--switch",
+        action="append",
+        default=[],
+        metavar="SELECTOR",
+        help="only work on switches matching SELECTOR: a name, a glob, or OPTION=VALUE of data/switches.ini",
+    )
+    parser.add_argument(
+        "--host",
+        action="append",
+        default=[],
+        metavar="SELECTOR",
+        help="configure: only label ports of hosts matching SELECTOR (a name or glob)",
+    )
+    parser.add_argument(
+        "--snapshot-format",
+        choices=compact.FORMATS,
+        help="format of written snapshots (default: text for acquire, compact for convert-snapshots)",
+    )
+    parser.add_argument(
+        "--db",
+        metavar="FILE",
+        help="acquire: also write the parsed data to the SQLite database FILE; configure: read the data from FILE",
+    )
+    parser.add_argument("--no-cache", action="store_true", help="do not use or update the cache of parsed switch data")
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=1,
+        help="parse switch data up front in this many processes (default: %(default)s, parse lazily in-process)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only link and render switches affected by changes since the previous --incremental run",
+    )
+    parser.add_argument(
+        "--verify-incremental",
+        action="store_true",
+        help="like --incremental, and check that the result is the same as a full run",
+    )
+    parser.add_argument(
+        "--columnar", action="store_true", help="match host MACs against a columnar mactable (needs numpy)"
+    )
+    parser.add_argument("--metrics-json", metavar="FILE", help="write timings and counts of this run as JSON")
+    parser.add_argument(
+        "--metrics-prom", metavar="FILE", help="write timings and counts in the Prometheus textfile-collector format"
+    )
+    parser.add_argument("--profile", metavar="DIR", help="profile the run, and write the results to DIR")
+    parser.add_argument(
+        "--profile-phase",
+        choices=profiling.PHASES,
+        default="all",
+        help="profile only this phase of the run (default: %(default)s)",
+    )
+    options = parser.parse_args(args[1:])
+    if (options.incremental or options.verify_incremental) and (
+        options.switch or options.host or options.db or options.columnar
+    ):
+        parser.error("--incremental cannot be combined with --switch, --host, --db or --columnar")
+    if options.action in ("acquire-configure", "acquire-configure-apply") and (
+        options.switch
+        or options.host
+        or options.db
+        or options.columnar
+        or options.incremental
+        or options.verify_incremental
+    ):
+        parser.error(
+            "%s cannot be combined with --switch, --host, --db, --columnar, --incremental or --verify-incremental"
+            % options.action
+        )
+    if options.profile:
+        profiling.enable(options.profile_phase)
+    try:
+        with profiling.phase("all"):
+            ok = run_action(options)
+    finally:
+        if options.profile:
+            profiling.write(options.profile)
+        if options.metrics_json:
+            metrics.write_json(options.metrics_json)
+        if options.metrics_prom:
+            metrics.write_prometheus(options.metrics_prom)
 
     if not ok:
-        print("Usage: %s ACTION" % args[0])
-        print()
-        print("Where ACTION is one of:")
-        print("  * configure")
-        print("  * configure-apply")
-        print("  * acquire")
-        print("  * acquire-puppetdb")
-        print("  * acquire-switches")
         sys.exit(1)
 
 
@@ -1,10 +1,33 @@
+from functools import partial
 from glob import glob
 from subprocess import check_call
+from urllib.parse import urlencode, urlsplit
+import gzip
+import http.client
+import io
 import json
+import os
+import ssl
 
+from . import compact
+from . import metrics
 
-def ssh_curl_into_file(device_name, fact_name, outfile):
-    query = ('query=["and",["=","node_state","active"],["=","name","' + fact_name + '"]]').replace('"', '\\"')
+FACT_NAMES = ["fibrechannel", "ipmi", "lldp", "networking"]
+
+# Stable order for paged queries, so pages neither overlap nor skip records
+PAGE_ORDER = json.dumps([{"field": "certname"}, {"field": "name"}], separators=(",", ":"))
+
+
+def facts_query(fact_names):
+    if len(fact_names) == 1:
+        name_filter = ["=", "name", fact_names[0]]
+    else:
+        name_filter = ["in", "name", ["array", fact_names]]
+    return json.dumps(["and", ["=", "node_state", "active"], name_filter], separators=(",", ":"))
+
+
+def ssh_curl_into_file(device_name, fact_names, outfile):
+    query = ("query=" + facts_query(fact_names)).replace('"', '\\"')
     command = [
         "ssh",
         device_name,
@@ -15,66 +38,336 @@ def ssh_curl_into_file(device_name, fact_name, outfile):
         "--data-urlencode",
         query,
     ]
-    check_call(command, stdout=outfile)
+    with metrics.timed("puppetdb_query", server=device_name, facts=",".join(fact_names)):
+        check_call(command, stdout=outfile)
+    metrics.add(
+        "puppetdb_received_bytes", os.fstat(outfile.fileno()).st_size, server=device_name, facts=",".join(fact_names)
+    )
 
 
-def acquire(device_name, connect_options, datadir):
-    print("Connecting to", device_name)
-    for fact_name in ["fibrechannel", "ipmi", "lldp", "networking"]:
-        with open("%s/%s.%s.json" % (datadir, device_name, fact_name), "wt") as fp:
-            ssh_curl_into_file(device_name, fact_name, fp)
+def http_connection(connect_options):
+    """
+    Connection to the PuppetDB HTTP API at `url` (default http://localhost:8080, e.g. a port forwarded with
+    `ssh -L 8080:localhost:8080`). It is kept alive for all queries of one acquire().
+    """
+    url = urlsplit(connect_options.get("url", "http://localhost:8080"))
+    timeout = float(connect_options.get("timeout", 300))
+    if url.scheme == "https":
+        context = ssl.create_default_context()
+        if connect_options.get("verify_tls", "yes").lower() not in ("yes", "true", "on", "1"):
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return http.client.HTTPSConnection(url.hostname, url.port or 443, timeout=timeout, context=context)
+    return http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
 
 
-def read_fibrechannel(datadir):
-    data = {}
-    for fn in glob("%s/*.fibrechannel.json" % datadir):
+def http_get(conn, path):
+    for attempt in range(2):
+        try:
+            conn.request("GET", path, headers={"Accept": "application/json", "Accept-Encoding": "gzip"})
+            response = conn.getresponse()
+            break
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            # the server closed the kept-alive connection, reconnect once
+            conn.close()
+            if attempt:
+                raise
+    if response.status != 200:
+        body = response.read().decode("utf-8", "replace").strip()
+        raise RuntimeError("PuppetDB query failed: HTTP %d %s %s" % (response.status, response.reason, body[:200]))
+    return response
+
+
+def http_query_into_file(device_name, conn, connect_options, fact_names, outfile):
+    """
+    Write the facts as one JSON array to `outfile`, like ssh_curl_into_file. Queries are paged by `page_size`
+    records (0: one query), every page is gzip-compressed on the wire and written out record by record as it
+    arrives, so memory use does not grow with the size of the installation.
+    """
+    url = urlsplit(connect_options.get("url", "http://localhost:8080"))
+    page_size = int(connect_options.get("page_size", 10000))
+    offset = 0
+    count = 0
+    outfile.write("[")
+    with metrics.timed("puppetdb_query", server=device_name, facts=",".join(fact_names)):
+        while True:
+            params = {"query": facts_query(fact_names)}
+            if page_size:
+                params.update({"limit": page_size, "offset": offset, "order_by": PAGE_ORDER})
+            response = http_get(conn, "%s/pdb/query/v4/facts?%s" % (url.path.rstrip("/"), urlencode(params)))
+            metrics.add("puppetdb_requests", 1, server=device_name)
+            if response.getheader("Content-Encoding", "").lower() == "gzip":
+                body = gzip.GzipFile(fileobj=response)
+            else:
+                body = response
+            fp = io.TextIOWrapper(body, encoding="utf-8")
+            page_count = 0
+            for el in iter_json_array(fp, chunk_size=1 << 16):
+                if count:
+                    outfile.write(",")
+                json.dump(el, outfile)
+                count += 1
+                page_count += 1
+            # read up to the end of the response, so the connection can be reused
+            fp.read()
+            response.read()
+            if not page_size or page_count < page_size:
+                break
+            offset += page_size
+    outfile.write("]")
+    outfile.flush()
+    metrics.add(
+        "puppetdb_received_bytes", os.fstat(outfile.fileno()).st_size, server=device_name, facts=",".join(fact_names)
+    )
+
+
+def snapshot_filename(datadir, device_name, fact_name, snapshot_format="text"):
+    if snapshot_format == "compact":
+        return "%s/%s.%s.rec" % (datadir, device_name, fact_name)
+    return "%s/%s.%s.json" % (datadir, device_name, fact_name)
+
+
+def split_facts_file(device_name, fn, datadir):
+    """Split a response containing several facts into one file per fact, as the read_* functions expect."""
+    outfiles = {
+        fact_name: open(snapshot_filename(datadir, device_name, fact_name) + ".tmp", "wt") for fact_name in FACT_NAMES
+    }
+    try:
+        counts = {fact_name: 0 for fact_name in FACT_NAMES}
+        for outfile in outfiles.values():
+            outfile.write("[")
         with open(fn, "rt") as fp:
-            for el in json.load(fp):
-                if not el["value"]["hosts"]:
+            for el in iter_json_array(fp):
+                if el["name"] not in outfiles:
                     continue
-                data[el["certname"]] = el["value"]["hosts"]
-    return data
+                if counts[el["name"]]:
+                    outfiles[el["name"]].write(",")
+                json.dump(el, outfiles[el["name"]])
+                counts[el["name"]] += 1
+        for outfile in outfiles.values():
+            outfile.write("]")
+    finally:
+        for outfile in outfiles.values():
+            outfile.close()
 
 
-def read_ipmi(datadir):
-    data = {}
-    for fn in glob("%s/*.ipmi.json" % datadir):
-        with open(fn, "rt") as fp:
-            for el in json.load(fp):
-                data[el["certname"]] = el["value"]
-    return data
+def acquire(device_name, connect_options, datadir, snapshot_format="text"):
+    """
+    Fetch all facts from one PuppetDB server. Files are written to *.tmp first and only renamed into place
+    once every fact was fetched, so a failure keeps the previous snapshot of this server intact.
+    """
+    print("Connecting to", device_name)
+    if connect_options.get("transport", "ssh") == "http":
+        conn = http_connection(connect_options)
+        query_into_file = partial(http_query_into_file, device_name, conn, connect_options)
+    elif connect_options.get("transport", "ssh") == "ssh":
+        conn = None
+        query_into_file = partial(ssh_curl_into_file, device_name)
+    else:
+        raise ValueError("unknown PuppetDB transport %r" % connect_options["transport"])
+    try:
+        if connect_options.get("combined_query", "no").lower() in ("yes", "true", "on", "1"):
+            fn = "%s/%s.combined.json.tmp" % (datadir, device_name)
+            with open(fn, "wt") as fp:
+                query_into_file(FACT_NAMES, fp)
+            split_facts_file(device_name, fn, datadir)
+            os.unlink(fn)
+        else:
+            for fact_name in FACT_NAMES:
+                with open(snapshot_filename(datadir, device_name, fact_name) + ".tmp", "wt") as fp:
+                    query_into_file([fact_name], fp)
+    finally:
+        if conn is not None:
+            conn.close()
 
+    for fact_name in FACT_NAMES:
+        fn = snapshot_filename(datadir, device_name, fact_name)
+        if snapshot_format == "compact":
+            compact_fn = snapshot_filename(datadir, device_name, fact_name, "compact")
+            with open(fn + ".tmp", "rt") as fp:
+                compact.write_records(compact_fn + ".tmp", iter_json_array(fp))
+            os.unlink(fn + ".tmp")
+            fn = compact_fn
+        os.replace(fn + ".tmp", fn)
+        remove_other_formats(datadir, device_name, fact_name, snapshot_format)
 
-def read_lldp(datadir):
-    ifaces = []
-    for fn in glob("%s/*.lldp.json" % datadir):
+
+def remove_other_formats(datadir, device_name, fact_name, snapshot_format):
+    for other_format in compact.FORMATS:
+        fn = snapshot_filename(datadir, device_name, fact_name, other_format)
+        if other_format != snapshot_format and os.path.exists(fn):
+            os.unlink(fn)
+
+
+def snapshot_files(datadir):
+    """All fact files in `datadir`, in either snapshot format, as (filename, device name, fact name, format)."""
+    for snapshot_format, extension in (("text", "json"), ("compact", "rec")):
+        for fn in glob("%s/*.%s" % (datadir, extension)):
+            device_name, fact_name, _ = os.path.basename(fn).rsplit(".", 2)
+            yield fn, device_name, fact_name, snapshot_format
+
+
+def iter_fact_records(fn):
+    if fn.endswith(".rec"):
+        yield from compact.iter_records(fn)
+    else:
         with open(fn, "rt") as fp:
-            for el in json.load(fp):
-                if not el["value"]["neighbors"]:
+            yield from iter_json_array(fp)
+
+
+def convert_snapshots(datadir, snapshot_format):
+    """Rewrite all fact files in `datadir` in `snapshot_format`, keeping their modification times for --ttl."""
+    count = 0
+    for fn, device_name, fact_name, file_format in list(snapshot_files(datadir)):
+        if file_format == snapshot_format:
+            continue
+        converted_fn = snapshot_filename(datadir, device_name, fact_name, snapshot_format)
+        if snapshot_format == "compact":
+            compact.write_records(converted_fn + ".tmp", iter_fact_records(fn))
+        else:
+            with open(converted_fn + ".tmp", "wt") as fp:
+                fp.write("[")
+                for i, el in enumerate(iter_fact_records(fn)):
+                    if i:
+                        fp.write(",")
+                    json.dump(el, fp)
+                fp.write("]")
+        mtime = os.path.getmtime(fn)
+        os.replace(converted_fn + ".tmp", converted_fn)
+        os.utime(converted_fn, (mtime, mtime))
+        os.unlink(fn)
+        count += 1
+    print("I: converted", count, "PuppetDB fact files to the", snapshot_format, "format")
+
+
+def iter_json_array(fp, chunk_size=1 << 20):
+    """
+    Yield the elements of the JSON array in `fp` one by one, reading it in chunks,
+    so memory use is bounded by the largest element instead of the whole document.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    started = False
+    need_comma = False
+
+    def skip_whitespace(pos):
+        while pos < len(buf) and buf[pos] in " \t\r\n":
+            pos += 1
+        return pos
+
+    while True:
+        pos = skip_whitespace(pos)
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("expected a JSON array in %s" % getattr(fp, "name", fp))
+                started = True
+                pos = skip_whitespace(pos + 1)
+                if pos < len(buf) and buf[pos] == "]":
+                    return
+                continue
+            if buf[pos] == "]":
+                return
+            if buf[pos] == "," and need_comma:
+                need_comma = False
+                pos += 1
+                continue
+            if need_comma:
+                raise ValueError("expected ',' in JSON array in %s" % getattr(fp, "name", fp))
+            try:
+                el, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # a number may continue in the next chunk ("1" of "1.5"): only take it once its delimiter is read
+                delimiter = skip_whitespace(end)
+                if eof or (delimiter < len(buf) and buf[delimiter] in ",]"):
+                    yield el
+                    pos = end
+                    need_comma = True
                     continue
-                for iface_name, detail in el["value"]["neighbors"].items():
-                    ifaces.append(
-                        {
-                            "switchname": detail["sysname"].split()[0],
-                            "switchport": detail["portid"].split()[1],
-                            "hostname": el["certname"],
-                            "hostport": iface_name,
-                        }
-                    )
+        elif eof:
+            raise ValueError("unexpected end of JSON array in %s" % getattr(fp, "name", fp))
 
-    return ifaces
+        chunk = fp.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
 
 
-def read_networking(datadir):
-    data = {}
-    for fn in glob("%s/*.networking.json" % datadir):
-        with open(fn, "rt") as fp:
-            for el in json.load(fp):
-                interfaces = {
-                    k: {"mac": val["mac"].replace(":", "").lower()}
-                    for k, val in el["value"]["interfaces"].items()
-                    if isinstance(val, dict) and (k.startswith("eth") or k.startswith("en")) and "mac" in val
-                }
-                data[el["certname"]] = interfaces
+def add_fibrechannel(data, el):
+    if el["value"]["hosts"]:
+        data[el["certname"]] = el["value"]["hosts"]
+
+
+def add_ipmi(data, el):
+    data[el["certname"]] = el["value"]
+
+
+def add_lldp(ifaces, el):
+    if not el["value"]["neighbors"]:
+        return
+    for iface_name, detail in el["value"]["neighbors"].items():
+        ifaces.append(
+            {
+                "switchname": detail["sysname"].split()[0],
+                "switchport": detail["portid"].split()[1],
+                "hostname": el["certname"],
+                "hostport": iface_name,
+            }
+        )
+
+
+def add_networking(data, el):
+    interfaces = {
+        k: {"mac": val["mac"].replace(":", "").lower()}
+        for k, val in el["value"]["interfaces"].items()
+        if isinstance(val, dict) and (k.startswith("eth") or k.startswith("en")) and "mac" in val
+    }
+    data[el["certname"]] = interfaces
+
+
+# fact name -> (type of the collected data, function adding one PuppetDB fact record to it)
+FACT_READERS = {
+    "fibrechannel": (dict, add_fibrechannel),
+    "ipmi": (dict, add_ipmi),
+    "lldp": (list, add_lldp),
+    "networking": (dict, add_networking),
+}
 
+
+@metrics.timed("read_facts")
+def read_facts(datadir, fact_names=FACT_NAMES):
+    """
+    Read all `fact_names` in one pass over `datadir`, streaming each file, in either snapshot format.
+    Returns a dict fact name -> data.
+    """
+    data = {fact_name: FACT_READERS[fact_name][0]() for fact_name in fact_names}
+    for fn, _, fact_name, _ in snapshot_files(datadir):
+        if fact_name not in data:
+            continue
+        add = FACT_READERS[fact_name][1]
+        for el in iter_fact_records(fn):
+            add(data[fact_name], el)
+    for fact_name, fact_data in data.items():
+        metrics.add("puppetdb_records", len(fact_data), fact=fact_name)
     return data
+
+
+def read_fibrechannel(datadir):
+    return read_facts(datadir, ["fibrechannel"])["fibrechannel"]
+
+
+def read_ipmi(datadir):
+    return read_facts(datadir, ["ipmi"])["ipmi"]
+
+
+def read_lldp(datadir):
+    return read_facts(datadir, ["lldp"])["lldp"]
+
+
+def read_networking(datadir):
+    return read_facts(datadir, ["networking"])["networking"]
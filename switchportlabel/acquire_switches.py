@@ -1,6 +1,20 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 from glob import glob
-from netmiko import Netmiko
+from netmiko import Netmiko, NetmikoTimeoutException, ReadTimeout
 import json
+import os
+import socket
+import time
+
+from . import compact
+from . import metrics
+from . import netconf
+from . import nxapi
+from . import parse_cache
+from . import parser_engine
+from . import profiling
+from . import snmp
 
 
 ACQUIRE_COMMANDS = {
@@ -19,7 +33,16 @@ ACQUIRE_COMMANDS = {
     },
 }
 
+# Bump when a parse_* function changes its output, to invalidate cached parse results.
+PARSER_VERSION = 3
+
+# Retries after a failed acquisition, and base delay in seconds (doubled after every attempt).
+ACQUIRE_RETRIES = 2
+ACQUIRE_BACKOFF = 5
 
+
+# cached: a mactable names the same few ports on every line
+@lru_cache(maxsize=4096)
 def expand_hp_comware_interface_name(shortname):
     return (
         shortname.replace("XGE", "Ten-GigabitEthernet")
@@ -29,6 +52,60 @@ def expand_hp_comware_interface_name(shortname):
     )
 
 
+def nxos_interface_name(name):
+    """Short interface name as used in the other outputs, and the full name as alias."""
+    aliases = [name]
+    name = name.replace("Ethernet", "Eth")
+    name = name.replace("port-channel", "Po")
+    if name == aliases[0]:
+        aliases = []
+    return name, aliases
+
+
+def nxos_rows(data, table, row):
+    """Rows of a table in NX-OS JSON output. A single row is not wrapped in a list, and empty tables are left out."""
+    rows = (data or {}).get(table, {}).get(row, [])
+    if isinstance(rows, dict):
+        rows = [rows]
+    return rows
+
+
+def set_nxos_description(iface, value):
+    iface["description"] = value.strip()
+
+
+def set_nxos_wwn(iface, value):
+    iface["address"] = value.replace(":", "")
+
+
+def set_nxos_fc_hardware(iface, value):
+    iface["type"] = value.split(",")[0]
+
+
+def set_nxos_members(iface, value):
+    iface["members"] = value.split()
+
+
+def set_nxos_ethernet_hardware(iface, value):
+    # "Hardware: 1000/10000 Ethernet, address: 00de.fbee.abab (bia 00de.fbee.abab)"
+    cs = [x.strip().split(":") for x in value.split(",")]
+    iface["type"] = cs[0][0].strip()
+    if len(cs) > 1 and len(cs[1]) > 1:
+        iface["address"] = cs[1][1].strip().split()[0].replace(".", "")
+
+
+NXOS_INTERFACE_RULES = parser_engine.compile_rules(
+    [
+        (parser_engine.PREFIX, "Port description is ", set_nxos_description),
+        (parser_engine.PREFIX, "Description:", set_nxos_description),
+        (parser_engine.PREFIX, "Port WWN is ", set_nxos_wwn),
+        (parser_engine.PREFIX, "Hardware is ", set_nxos_fc_hardware),
+        (parser_engine.PREFIX, "Members in this channel:", set_nxos_members),
+        (parser_engine.PREFIX, "Hardware:", set_nxos_ethernet_hardware),
+    ]
+)
+
+
 def parse_cisco_nxos_interfaces(device_name, text):
     """
     fc2/11 is down (Link failure: loss of sync)
@@ -94,51 +171,25 @@ def parse_cisco_nxos_interfaces(device_name, text):
         0 Tx pause
 
     """
-    iface = None
-    ifaces = []
-    indent = 0
-    for line in text.splitlines():
-        indent = 0
-        for char in line:
-            if char == " ":
-                indent += 1
-            else:
-                break
-
-        line = line.strip()
-        wsplit = line.split()
-
-        if indent == 0 and line and wsplit[1] == "is":
-            if iface:
-                ifaces.append(iface)
-            name = wsplit[0]
-            aliases = [name]
-            name = name.replace("Ethernet", "Eth")
-            name = name.replace("port-channel", "Po")
-            if name == aliases[0]:
-                aliases = []
-            state = wsplit[2]  # up/down
-            iface = {"switchname": device_name, "switchport": name, "state": state, "switchport_aliases": aliases}
-        elif iface and indent and line.startswith("Dedicated Interface") or line.startswith("vPC Status:"):
-            continue
-        elif iface and indent and line.startswith("Port description is"):
-            iface["description"] = line.split("Port description is ", 1)[1].strip()
-        elif iface and indent and line.startswith("Description:"):
-            iface["description"] = line.split(":", 1)[1].strip()
-        elif iface and indent and line.startswith("Port WWN is"):
-            iface["address"] = line.split("Port WWN is ", 1)[1].replace(":", "")
-        elif iface and indent and line.startswith("Hardware is"):
-            iface["type"] = line.split("Hardware is ", 1)[1].split(",")[0]
-        elif iface and indent and line.startswith("Members in this channel:"):
-            iface["members"] = line.split(":", 1)[1].split()
-        elif iface and indent and line.startswith("Hardware:"):
-            cs = [x.strip().split(":") for x in line.split(",")]
-            iface["type"] = cs[0][1].strip()
-            iface["address"] = cs[1][1].strip().split()[0].replace(".", "")
-
-    if iface:
-        ifaces.append(iface)
-    return ifaces
+
+    def header(indent, line):
+        if indent != 0:
+            return None
+        wsplit = line.split(None, 3)
+        if len(wsplit) < 3 or wsplit[1] != "is":
+            return None
+        name, aliases = nxos_interface_name(wsplit[0])
+        state = wsplit[2]  # up/down
+        return {"switchname": device_name, "switchport": name, "state": state, "switchport_aliases": aliases}
+
+    return parser_engine.parse_blocks(
+        text,
+        header,
+        NXOS_INTERFACE_RULES,
+        body_indent=bool,
+        blank_line_ends_block=False,
+        headers_inside_block=True,
+    )
 
 
 def map_flogi(switch, data):
@@ -157,18 +208,55 @@ def parse_cisco_nxos_flogi(device_name, text):
     fc2/13           1     0x0b00c0  10:00:e0:07:1b:d4:f4:41 20:00:e0:07:1b:d4:f4:41
     fc2/17           1     0x0b0160  10:00:00:90:fa:ce:cf:16 20:00:00:90:fa:ce:cf:16
     """
+    return parser_engine.parse_rows(
+        text,
+        lambda line: line.startswith("fc"),
+        lambda line: {
+            "switchport": line[0],
+            "vsan": line[1],
+            "fcid": line[2].replace("0x", ""),
+            "port_name": line[3].replace(":", ""),
+            "node_name": line[4].replace(":", ""),
+        },
+    )
+
+
+def parse_cisco_nxos_nxapi_interfaces(device_name, json_text):
+    ifaces = []
+    for row in nxos_rows(json.loads(json_text), "TABLE_interface", "ROW_interface"):
+        name, aliases = nxos_interface_name(row["interface"])
+        # SVI rows have svi_* keys only
+        state = row.get("state", row.get("svi_line_proto", ""))
+        iface = {"switchname": device_name, "switchport": name, "state": state, "switchport_aliases": aliases}
+        # Ethernet and port-channel rows use "desc", FC rows "port_description"
+        for key in ("desc", "port_description", "svi_desc"):
+            if key in row:
+                iface["description"] = row[key].strip()
+        if name.startswith("fc"):
+            iface["type"] = "Fibre Channel"
+            if "port_wwn" in row:
+                iface["address"] = row["port_wwn"].replace(":", "")
+        else:
+            iface["type"] = row.get("eth_hw_desc", row.get("svi_hw_desc", ""))
+            address = row.get("eth_hw_addr", row.get("svi_mac"))
+            if address:
+                iface["address"] = address.replace(".", "")
+        if "eth_members" in row:
+            iface["members"] = [member.strip() for member in row["eth_members"].split(",")]
+        ifaces.append(iface)
+    return ifaces
+
+
+def parse_cisco_nxos_nxapi_flogi(device_name, json_text):
     rows = []
-    for line in text.splitlines():
-        if not line.startswith("fc"):
-            continue
-        line = line.split()
+    for row in nxos_rows(json.loads(json_text), "TABLE_flogi_entry", "ROW_flogi_entry"):
         rows.append(
             {
-                "switchport": line[0],
-                "vsan": line[1],
-                "fcid": line[2].replace("0x", ""),
-                "port_name": line[3].replace(":", ""),
-                "node_name": line[4].replace(":", ""),
+                "switchport": row["interface"],
+                "vsan": str(row["vsan"]),
+                "fcid": row["fcid"].replace("0x", ""),
+                "port_name": row["port_name"].replace(":", ""),
+                "node_name": row["node_name"].replace(":", ""),
             }
         )
     return rows
@@ -180,6 +268,46 @@ def map_interfaces(switch, data):
     return {iface["switchport"]: iface for iface in data}
 
 
+def map_interface_aliases(interfaces):
+    """Map alias -> switchport, for names that are not a key of `interfaces` (e.g. "Ethernet1/4" -> "Eth1/4")."""
+    aliases = {}
+    for switchport, iface in interfaces.items():
+        for alias in iface.get("switchport_aliases", []):
+            aliases.setdefault(alias, switchport)
+    return aliases
+
+
+def set_comware_stack(iface, line):
+    # Could also be "Media type is stack wire,Port hardware type is STACK_SFP_PLUS"
+    line = line.split(",")
+    if line[-1].split()[-1].startswith("STACK_"):
+        iface["stack"] = True
+
+
+def set_comware_state(iface, value):
+    iface["state"] = value.lower()
+
+
+def set_comware_description(iface, value):
+    iface["description"] = value
+
+
+def set_comware_frame_type(iface, value):
+    if value.startswith("Ethernet"):
+        iface["type"] = "Ethernet"
+        iface["address"] = value.split(",")[1].split(":")[1].strip().replace("-", "")
+
+
+COMWARE_INTERFACE_RULES = parser_engine.compile_rules(
+    [
+        (parser_engine.CONTAINS, "port hardware type is", set_comware_stack),
+        (parser_engine.KEY, "Current state", set_comware_state),
+        (parser_engine.KEY, "Description", set_comware_description),
+        (parser_engine.KEY, "IP packet frame type", set_comware_frame_type),
+    ]
+)
+
+
 def parse_hp_comware_interfaces(device_name, text):
     """
     Ten-GigabitEthernet2/0/34
@@ -227,54 +355,29 @@ def parse_hp_comware_interfaces(device_name, text):
 
     """
 
-    iface = None
-    ifaces = []
-    for line in text.splitlines():
-        if line == "" and iface:
-            ifaces.append(iface)
-            iface = None
-        if not line:
-            continue
-
-        indent = 0
-        for char in line:
-            if char == " ":
-                indent += 1
-            else:
-                break
-
-        line = line.strip()
-
-        if not iface:
-            if indent in (0, 1) and "current state:" in line:
-                # comware 5
-                line = line.split()
-                iface = {"switchname": device_name, "switchport": line[0], "state": line[3].lower()}
-            elif indent == 0:
-                # comware 7, state is in a dedicated line
-                iface = {"switchname": device_name, "switchport": line}
-            if iface:
-                iface["switchport_aliases"] = []
-        elif indent in (0, 1) and "port hardware type is" in line.lower():
-            # Could also be "Media type is stack wire,Port hardware type is STACK_SFP_PLUS"
-            line = line.split(",")
-            if line[-1].split()[-1].startswith("STACK_"):
-                iface["stack"] = True
-        elif indent in (0, 1):
-            csplit = line.split(": ", 1)
-            if csplit[0] == "Current state":
-                iface["state"] = csplit[1].lower()
-            elif csplit[0] == "Description":
-                iface["description"] = csplit[1]
-            elif csplit[0] == "Description":
-                iface["description"] = csplit[1]
-            elif csplit[0] == "IP packet frame type" and csplit[1].startswith("Ethernet"):
-                iface["type"] = "Ethernet"
-                iface["address"] = csplit[1].split(",")[1].split(":")[1].strip().replace("-", "")
-
-    if iface:
-        ifaces.append(iface)
-    return ifaces
+    def header(indent, line):
+        if indent in (0, 1) and "current state:" in line:
+            # comware 5
+            line = line.split()
+            return {
+                "switchname": device_name,
+                "switchport": line[0],
+                "state": line[3].lower(),
+                "switchport_aliases": [],
+            }
+        elif indent == 0:
+            # comware 7, state is in a dedicated line
+            return {"switchname": device_name, "switchport": line, "switchport_aliases": []}
+        return None
+
+    return parser_engine.parse_blocks(
+        text,
+        header,
+        COMWARE_INTERFACE_RULES,
+        body_indent=lambda indent: indent in (0, 1),
+        blank_line_ends_block=True,
+        headers_inside_block=False,
+    )
 
 
 parse_hp_procurve_interfaces = parse_hp_comware_interfaces
@@ -380,8 +483,7 @@ def map_lldp(switch, data):
 
 def parse_cisco_nxos_lldp(device_name, json_text):
     ifaces = []
-    rows = json.loads(json_text)["TABLE_nbor_detail"]["ROW_nbor_detail"]
-    for row in rows:
+    for row in nxos_rows(json.loads(json_text), "TABLE_nbor_detail", "ROW_nbor_detail"):
         if row["l_port_id"] == "mgmt0":
             continue
         iface = {
@@ -394,6 +496,37 @@ def parse_cisco_nxos_lldp(device_name, json_text):
     return ifaces
 
 
+def set_comware_lldp_hostport(iface, value):
+    iface["hostport"] = value
+
+
+def set_comware_lldp_hostporttype(iface, value):
+    iface["hostporttype"] = value
+
+
+def set_comware_lldp_hostport_description(iface, value):
+    if iface.get("hostporttype") == "MAC address":
+        iface["hostport"] = value
+    else:
+        iface.pop("hostporttype", None)
+
+
+def set_comware_lldp_hostname(iface, value):
+    iface["hostname"] = value
+
+
+COMWARE_LLDP_RULES = parser_engine.compile_rules(
+    [
+        (parser_engine.KEY, "Port ID", set_comware_lldp_hostport),
+        (parser_engine.KEY, "Port ID type", set_comware_lldp_hostporttype),
+        (parser_engine.KEY, "Port ID description", set_comware_lldp_hostport_description),
+        (parser_engine.KEY, "System name", set_comware_lldp_hostname),
+    ],
+    strip_keys=True,
+    strip_values=True,
+)
+
+
 def parse_hp_comware_lldp(device_name, text):
     """
     LLDP neighbor-information of port 33[Ten-GigabitEthernet1/0/33]:
@@ -429,47 +562,20 @@ def parse_hp_comware_lldp(device_name, text):
     OperMau                    : Speed(1000)/Duplex(Full)
 
     """
-    iface = None
-    ifaces = []
-    for line in text.splitlines():
-        if line == "" and iface:
-            ifaces.append(iface)
-            iface = None
-        if not line:
-            continue
-
-        indent = 0
-        for char in line:
-            if char == " ":
-                indent += 1
-            else:
-                break
-
-        line = line.strip()
 
-        if not iface:
-            if indent == 0 and line.startswith("LLDP neighbor-information of port"):
-                iface = {"switchname": device_name, "switchport": line.split("[")[1].split("]")[0].strip()}
-        else:
-            csplit = line.split(": ", 1)
-            csplit[0] = csplit[0].strip()
-            if len(csplit) > 1:
-                csplit[1] = csplit[1].strip()
-                if csplit[0] == "Port ID":
-                    iface["hostport"] = csplit[1]
-                elif csplit[0] == "Port ID type":
-                    iface["hostporttype"] = csplit[1]
-                elif csplit[0] == "Port ID description":
-                    if iface["hostporttype"] == "MAC address":
-                        iface["hostport"] = csplit[1]
-                    else:
-                        del iface["hostporttype"]
-                elif csplit[0] == "System name":
-                    iface["hostname"] = csplit[1]
-
-    if iface:
-        ifaces.append(iface)
-    return ifaces
+    def header(indent, line):
+        if indent == 0 and line.startswith("LLDP neighbor-information of port"):
+            return {"switchname": device_name, "switchport": line.split("[")[1].split("]")[0].strip()}
+        return None
+
+    return parser_engine.parse_blocks(
+        text,
+        header,
+        COMWARE_LLDP_RULES,
+        body_indent=lambda indent: True,
+        blank_line_ends_block=True,
+        headers_inside_block=False,
+    )
 
 
 def map_mactable(switch, data):
@@ -478,8 +584,7 @@ def map_mactable(switch, data):
 
 def parse_cisco_nxos_mactable(device_name, json_text):
     mactable = []
-    rows = json.loads(json_text)["TABLE_mac_address"]["ROW_mac_address"]
-    for row in rows:
+    for row in nxos_rows(json.loads(json_text), "TABLE_mac_address", "ROW_mac_address"):
         entry = {
             "address": row["disp_mac_addr"].replace(".", "").lower(),
             "vlan": row["disp_vlan"],
@@ -490,96 +595,528 @@ def parse_cisco_nxos_mactable(device_name, json_text):
     return mactable
 
 
+# NX-API returns the same JSON as "| json" on the CLI
+parse_cisco_nxos_nxapi_lldp = parse_cisco_nxos_lldp
+parse_cisco_nxos_nxapi_mactable = parse_cisco_nxos_mactable
+
+
 def parse_hp_comware_mactable(device_name, text):
-    mactable = []
-    for line in text.splitlines()[1:]:
-        if line.startswith("  --- ") or not line:
-            continue
-        line = line.split()
-        entry = {
+    return parser_engine.parse_rows(
+        text,
+        lambda line: line and not line.startswith("  --- "),
+        lambda line: {
             "address": line[0].replace("-", "").lower(),
             "vlan": line[1],
             "switchname": device_name,
             "switchport": expand_hp_comware_interface_name(line[3]),  # expand for comware5
+        },
+        skip_lines=1,
+    )
+
+
+# LLDP-MIB LldpPortIdSubtype, as named in the CLI output
+LLDP_PORT_ID_SUBTYPES = {
+    "1": "Interface alias",
+    "2": "Port component",
+    "3": "MAC address",
+    "4": "Network address",
+    "5": "Interface name",
+    "6": "Agent circuit ID",
+    "7": "Locally assigned",
+}
+
+
+def format_hp_comware_mac(mac):
+    """Format a MAC address as in the CLI output: "5C-8A-38-28-71-A8" -> "5c8a-3828-71a8"."""
+    mac = mac.replace("-", "").replace(":", "").lower()
+    return "%s-%s-%s" % (mac[0:4], mac[4:8], mac[8:12])
+
+
+def parse_hp_comware_netconf_interfaces(device_name, xml_text):
+    ifaces = []
+    for _, row in netconf.iter_rows(xml_text, {"Interface"}):
+        iface = {
+            "switchname": device_name,
+            "switchport": row["Name"],
+            "state": "up" if row.get("OperStatus") == "1" else "down",
+            "switchport_aliases": [],
         }
-        mactable.append(entry)
+        if "Description" in row:
+            iface["description"] = row["Description"]
+        if row.get("MAC"):
+            iface["type"] = "Ethernet"
+            iface["address"] = row["MAC"].replace("-", "").replace(":", "").lower()
+        ifaces.append(iface)
+    return ifaces
+
+
+def parse_hp_comware_netconf_lldp(device_name, xml_text):
+    names = {}
+    neighbors = []
+    for tag, row in netconf.iter_rows(xml_text, {"Interface", "NbrInfo"}):
+        if tag == "Interface":
+            names[row["IfIndex"]] = row["Name"]
+        elif row.get("AgentID", "1") == "1":  # nearest bridge agent only, as on the CLI
+            neighbors.append(row)
+
+    ifaces = []
+    for row in neighbors:
+        hostporttype = LLDP_PORT_ID_SUBTYPES.get(row.get("PortIdSubtype"), row.get("PortIdSubtype"))
+        hostport = row.get("PortId", "")
+        if hostporttype == "MAC address":
+            hostport = format_hp_comware_mac(hostport)
+        ifaces.append(
+            {
+                "switchname": device_name,
+                "switchport": names.get(row["IfIndex"], row["IfIndex"]),
+                "hostporttype": hostporttype,
+                "hostport": hostport,
+                "hostname": row.get("SystemName", ""),
+            }
+        )
+    return ifaces
+
+
+def parse_hp_comware_netconf_mactable(device_name, xml_text):
+    names = {}
+    entries = []
+    for tag, row in netconf.iter_rows(xml_text, {"Interface", "Unicast"}):
+        if tag == "Interface":
+            names[row["IfIndex"]] = row["Name"]
+        else:
+            entries.append(row)
+
+    return [
+        {
+            "address": row["MacAddress"].replace("-", "").replace(":", "").lower(),
+            "vlan": row["VLANID"],
+            "switchname": device_name,
+            "switchport": names.get(row["PortIndex"], row["PortIndex"]),
+        }
+        for row in entries
+    ]
+
+
+def parse_snmp_interfaces(device_name, text, interface_name):
+    walk = snmp.parse_walk(text, snmp.SNMP_WALKS["interfaces"])
+    ifaces = []
+    for index, name in walk[snmp.IF_NAME].items():
+        iface = {
+            "switchname": device_name,
+            "switchport": interface_name(snmp.decode_string(name)),
+            "state": "up" if walk[snmp.IF_OPER_STATUS].get(index) == "1" else "down",
+            "switchport_aliases": [],
+        }
+        if index in walk[snmp.IF_ALIAS]:
+            iface["description"] = snmp.decode_string(walk[snmp.IF_ALIAS][index])
+        ifaces.append(iface)
+    return ifaces
+
+
+def snmp_lldp_local_port(walk, local_port):
+    """
+    Name of an LLDP local port: its lldpLocPortId, as in the CLI output, unless the subtype says the ID is not an
+    interface name (e.g. a MAC address); then ifName, as lldpLocPortNum is the ifIndex on these switches.
+    """
+    port_id = walk[snmp.LLDP_LOC_PORT_ID].get(local_port)
+    subtype = walk[snmp.LLDP_LOC_PORT_ID_SUBTYPE].get(local_port)
+    # snapshots from before the subtype was walked have the ID only
+    if port_id is not None and (subtype is None or LLDP_PORT_ID_SUBTYPES.get(subtype) == "Interface name"):
+        return snmp.decode_string(port_id)
+    if local_port in walk[snmp.IF_NAME]:
+        return snmp.decode_string(walk[snmp.IF_NAME][local_port])
+    return None
+
+
+def parse_snmp_lldp(device_name, text, interface_name):
+    walk = snmp.parse_walk(text, snmp.SNMP_WALKS["lldp"])
+    ifaces = []
+    # rows are indexed by timeMark.localPortNum.remIndex
+    for index, port_id in walk[snmp.LLDP_REM_PORT_ID].items():
+        switchport = snmp_lldp_local_port(walk, index.split(".")[1])
+        if switchport is None:
+            continue
+        subtype = walk[snmp.LLDP_REM_PORT_ID_SUBTYPE].get(index)
+        hostporttype = LLDP_PORT_ID_SUBTYPES.get(subtype, subtype)
+        if hostporttype == "MAC address":
+            hostport = format_hp_comware_mac(snmp.decode_octets(port_id).hex())
+        else:
+            hostport = snmp.decode_string(port_id)
+        ifaces.append(
+            {
+                "switchname": device_name,
+                "switchport": interface_name(switchport),
+                "hostporttype": hostporttype,
+                "hostport": hostport,
+                "hostname": snmp.decode_string(walk[snmp.LLDP_REM_SYS_NAME].get(index, "")),
+            }
+        )
+    return ifaces
+
+
+def parse_snmp_mactable(device_name, text, interface_name):
+    walk = snmp.parse_walk(text, snmp.SNMP_WALKS["mactable"])
+    # Q-BRIDGE-MIB rows are indexed by fdbId.mac (the fdbId is the VLAN on independent-learning switches),
+    # BRIDGE-MIB rows by mac only
+    rows = [index.split(".", 1) + [port] for index, port in walk[snmp.DOT1Q_TP_FDB_PORT].items()]
+    if not rows:
+        rows = [["", index, port] for index, port in walk[snmp.DOT1D_TP_FDB_PORT].items()]
+
+    mactable = []
+    for vlan, mac, bridge_port in rows:
+        if_index = walk[snmp.DOT1D_BASE_PORT_IF_INDEX].get(bridge_port)
+        if if_index not in walk[snmp.IF_NAME]:
+            # port 0 (the switch itself) or unknown
+            continue
+        mactable.append(
+            {
+                "address": "".join("%02x" % int(octet) for octet in mac.split(".")),
+                "vlan": vlan,
+                "switchname": device_name,
+                "switchport": interface_name(snmp.decode_string(walk[snmp.IF_NAME][if_index])),
+            }
+        )
     return mactable
 
 
+def parse_hp_comware_snmp_interfaces(device_name, text):
+    return parse_snmp_interfaces(device_name, text, expand_hp_comware_interface_name)
+
+
+def parse_hp_comware_snmp_lldp(device_name, text):
+    return parse_snmp_lldp(device_name, text, expand_hp_comware_interface_name)
+
+
+def parse_hp_comware_snmp_mactable(device_name, text):
+    return parse_snmp_mactable(device_name, text, expand_hp_comware_interface_name)
+
+
+def parse_hp_procurve_snmp_interfaces(device_name, text):
+    return parse_snmp_interfaces(device_name, text, str)
+
+
+def parse_hp_procurve_snmp_lldp(device_name, text):
+    return parse_snmp_lldp(device_name, text, str)
+
+
+def parse_hp_procurve_snmp_mactable(device_name, text):
+    return parse_snmp_mactable(device_name, text, str)
+
+
 def connect_options(device_options):
-    return {
+    options = {
         "ip": device_options["ip"],
         "username": device_options["username"],
         "password": device_options["password"],
         "device_type": device_options["device_type"],
     }
+    if "connect_timeout" in device_options:
+        options["conn_timeout"] = float(device_options["connect_timeout"])
+    return options
+
+
+def send_command_options(device_options):
+    if "command_timeout" in device_options:
+        return {"read_timeout": float(device_options["command_timeout"])}
+    return {}
+
+
+def snapshot_filename(datadir, device_name):
+    return "%s/%s.json" % (datadir, device_name)
+
+
+def raw_filename(datadir, device_name, datatype, snapshot_format="text"):
+    if snapshot_format == "compact":
+        return "%s/%s.%s.txt.gz" % (datadir, device_name, datatype)
+    return "%s/%s.%s.txt" % (datadir, device_name, datatype)
+
+
+def snapshot_filenames(datadir, device_name, snapshot_format="text"):
+    """All files of a device snapshot: the device info, and the raw output of every datatype."""
+    return [snapshot_filename(datadir, device_name)] + [
+        raw_filename(datadir, device_name, datatype, snapshot_format) for datatype in ACQUIRE_COMMANDS
+    ]
+
+
+def write_snapshot(datadir, total, snapshot_format="text"):
+    """
+    Write the raw_<datatype> outputs of `total` into one file per datatype, and the remaining device info
+    as JSON. All files are written atomically, the device info last. Raw files of the other snapshot format
+    are removed afterwards.
+    """
+    device_name = total["device_name"]
+    files = []
+    for datatype in ACQUIRE_COMMANDS:
+        fn = raw_filename(datadir, device_name, datatype, snapshot_format)
+        compact.write_text(fn + ".tmp", total.get("raw_%s" % datatype, ""), snapshot_format == "compact")
+        files.append(fn)
+    fn = snapshot_filename(datadir, device_name)
+    with open(fn + ".tmp", "wt") as fp:
+        json.dump({key: value for key, value in total.items() if not key.startswith("raw_")}, fp)
+    files.append(fn)
+    for fn in files:
+        os.replace(fn + ".tmp", fn)
+    for other_format in compact.FORMATS:
+        if other_format != snapshot_format:
+            for fn in snapshot_filenames(datadir, device_name, other_format)[1:]:
+                if os.path.exists(fn):
+                    os.unlink(fn)
+
+
+def acquire_ssh(device_name, device_options):
+    device_type = device_options["device_type"]
+    device_type_flavor = device_options.get("device_type_flavor", "")
+    raw = {}
+    print("Connecting to", device_name)
+    with metrics.timed("acquire_connect", device=device_name):
+        conn = Netmiko(**connect_options(device_options))
+    try:
+        for datatype, device_commands in ACQUIRE_COMMANDS.items():
+            command = device_commands.get("%s-%s" % (device_type, device_type_flavor), None)
+            if not command:
+                command = device_commands.get(device_type, None)
+            if command:
+                with metrics.timed("acquire_command", device=device_name, datatype=datatype):
+                    text = conn.send_command(command, **send_command_options(device_options))
+                metrics.add("acquire_received_bytes", len(text.encode()), device=device_name, datatype=datatype)
+            else:
+                text = ""
+            raw["raw_%s" % datatype] = text
+    finally:
+        conn.disconnect()
+    return raw
 
 
-def acquire(device_name, device_options, datadir):
+def check_transport(device_options):
+    """Raise if the device cannot be acquired with its transport at all, so this is not retried."""
+    device_type = device_options["device_type"]
+    transport = device_options.get("transport", "ssh")
+    # snapshots acquired with another transport than ssh are parsed by parse_<device_type>_<transport>_<datatype>
+    if transport != "ssh" and "parse_%s_%s_interfaces" % (device_type, transport) not in globals():
+        raise ValueError("transport %s is not supported for device_type %s" % (transport, device_type))
+    if transport == "netconf":
+        netconf.check(device_options)
+
+
+def acquire(device_name, device_options, datadir, snapshot_format="text"):
     device_type = device_options["device_type"]
     device_type_flavor = device_options.get("device_type_flavor", "")
-    total = {"device_type": device_type, "device_type_flavor": device_type_flavor, "device_name": device_name}
+    transport = device_options.get("transport", "ssh")
+    check_transport(device_options)
+    total = {
+        "device_type": device_type,
+        "device_type_flavor": device_type_flavor,
+        "device_name": device_name,
+        "transport": transport,
+        "acquired_at": time.time(),
+    }
 
-    if device_type != "none":
-        print("Connecting to", device_name)
-        try:
-            conn = Netmiko(**connect_options(device_options))
-
-            for datatype, device_commands in ACQUIRE_COMMANDS.items():
-                command = device_commands.get("%s-%s" % (device_type, device_type_flavor), None)
-                if not command:
-                    command = device_commands.get(device_type, None)
-                if command:
-                    text = conn.send_command(command)
-                else:
-                    text = ""
-                total["raw_%s" % datatype] = text
-        finally:
-            del conn
+    if device_type == "none":
+        raw = {}
+    elif transport == "nxapi":
+        raw = nxapi.acquire(device_name, device_options)
+    elif transport == "netconf":
+        raw = netconf.acquire(device_name, device_options)
+    elif transport == "snmp":
+        raw = snmp.acquire(device_name, device_options)
     else:
-        for datatype in ACQUIRE_COMMANDS:
-            total["raw_%s" % datatype] = ""
+        raw = acquire_ssh(device_name, device_options)
+    for datatype in ACQUIRE_COMMANDS:
+        total["raw_%s" % datatype] = raw.get("raw_%s" % datatype, "")
 
-    with open("%s/%s.json" % (datadir, device_name), "wt") as fp:
-        json.dump(total, fp)
+    # Written atomically, so a failed acquisition never leaves a truncated snapshot behind.
+    write_snapshot(datadir, total, snapshot_format)
 
 
-def read_switches(datadir):
-    switches = {}
-    for fn in glob("%s/*.json" % datadir):
+def is_timeout(exc):
+    return isinstance(exc, (NetmikoTimeoutException, ReadTimeout, socket.timeout))
+
+
+def is_transient(exc):
+    """Timeouts and lost connections are worth retrying; other errors (e.g. bad credentials) fail again."""
+    return is_timeout(exc) or isinstance(exc, (ConnectionError, EOFError) + netconf.TRANSIENT_ERRORS)
+
+
+def acquire_with_retries(device_name, device_options, datadir, snapshot_format="text"):
+    """
+    Call acquire(), retrying transient errors up to `retries` (device option, default ACQUIRE_RETRIES) times
+    with exponential backoff. The last exception is re-raised.
+    """
+    check_transport(device_options)
+    retries = int(device_options.get("retries", ACQUIRE_RETRIES))
+    try:
+        for attempt in range(retries + 1):
+            metrics.add("acquire_attempts", 1, device=device_name)
+            try:
+                with metrics.timed("acquire_device", device=device_name):
+                    return acquire(device_name, device_options, datadir, snapshot_format)
+            except Exception as e:
+                if attempt == retries or not is_transient(e):
+                    raise
+                delay = ACQUIRE_BACKOFF * 2**attempt
+                print("W: acquiring", device_name, "failed (%s), retrying in %ds" % (e, delay))
+                time.sleep(delay)
+    finally:
+        if device_options.get("transport", "ssh") == "nxapi":
+            # the kept-alive connection is only reused by retries
+            nxapi.close(device_options)
+
+
+def read_raw(datadir, switch, datatype):
+    """
+    Raw output of `datatype`, in either snapshot format. Snapshots written before per-datatype files have it
+    in the device info.
+    """
+    if "raw_%s" % datatype in switch:
+        return switch["raw_%s" % datatype]
+    for snapshot_format in compact.FORMATS:
+        try:
+            return compact.read_text(raw_filename(datadir, switch["device_name"], datatype, snapshot_format))
+        except FileNotFoundError:
+            pass
+    return ""
+
+
+def convert_snapshots(datadir, snapshot_format):
+    """Rewrite all switch snapshots in `datadir` in `snapshot_format`, keeping their modification times for --ttl."""
+    fns = glob("%s/*.json" % datadir)
+    for fn in fns:
+        mtime = os.path.getmtime(fn)
         with open(fn, "rt") as fp:
             switch = json.load(fp)
-            device_name = switch["device_name"]
-            device_type = switch["device_type"]
-            for datatype in ACQUIRE_COMMANDS:
-                parse_funcname = "parse_%s_%s" % (device_type, datatype)
-                mapper_funcname = "map_%s" % (datatype,)
-                if parse_funcname in globals():
-                    data = globals()[parse_funcname](device_name, switch["raw_%s" % datatype])
-                else:
-                    data = None
-                switch[datatype] = globals()[mapper_funcname](switch, data)
-
-            switches[device_name] = switch
+        total = dict(switch)
+        for datatype in ACQUIRE_COMMANDS:
+            total["raw_%s" % datatype] = read_raw(datadir, switch, datatype)
+        write_snapshot(datadir, total, snapshot_format)
+        for converted_fn in snapshot_filenames(datadir, switch["device_name"], snapshot_format):
+            os.utime(converted_fn, (mtime, mtime))
+    print("I: converted", len(fns), "switch snapshots to the", snapshot_format, "format")
+
+
+def parse_datatype(switch, datatype, datadir, cachedir):
+    device_name = switch["device_name"]
+    parser_name = switch["device_type"]
+    if switch.get("transport", "ssh") != "ssh":
+        parser_name = "%s_%s" % (parser_name, switch["transport"])
+    parse_funcname = "parse_%s_%s" % (parser_name, datatype)
+    mapper_funcname = "map_%s" % (datatype,)
+    if parse_funcname in globals():
+        with metrics.timed("parse", device=device_name, datatype=datatype), profiling.phase("parse"):
+            data = parse_cache.cached_parse(
+                cachedir,
+                PARSER_VERSION,
+                globals()[parse_funcname],
+                device_name,
+                read_raw(datadir, switch, datatype),
+            )
+    else:
+        data = None
+    # the raw text is not needed anymore
+    switch.pop("raw_%s" % datatype, None)
+    return globals()[mapper_funcname](switch, data)
+
+
+class LazySwitch(dict):
+    """
+    Device info of a switch snapshot. The parsed datatypes (switch["interfaces"], switch["mactable"], ...) and
+    switch["interface_aliases"] are read and parsed when first accessed.
+    """
+
+    def __init__(self, snapshot, datadir, cachedir):
+        super().__init__(snapshot)
+        self.datadir = datadir
+        self.cachedir = cachedir
+
+    def __missing__(self, key):
+        if key == "interface_aliases":
+            value = map_interface_aliases(self["interfaces"])
+        elif key in ACQUIRE_COMMANDS:
+            value = parse_datatype(self, key, self.datadir, self.cachedir)
+            if key == "interfaces":
+                metrics.add("interfaces", len(value), device=self["device_name"])
+            elif key == "mactable":
+                metrics.add("mactable_entries", len(value), device=self["device_name"])
+        else:
+            raise KeyError(key)
+        self[key] = value
+        return value
+
 
+def parse_snapshot(datadir, cachedir, fn):
+    """
+    Read a snapshot and parse all of its datatypes, in a worker process of read_switches().
+    Returns the switch as a plain dict, and the metrics recorded while parsing it.
+    """
+    metrics.reset()
+    with open(fn, "rt") as fp:
+        switch = LazySwitch(json.load(fp), datadir, cachedir)
+    for datatype in ACQUIRE_COMMANDS:
+        switch[datatype]
+    switch["interface_aliases"]
+    return dict(switch), metrics.collect()
+
+
+@metrics.timed("read_switches")
+def read_switches(datadir, cachedir=None, workers=1, selected=None):
+    """
+    Read the device info of all switch snapshots; datatypes are parsed on first access, see LazySwitch.
+    With more than one worker, all datatypes of all snapshots (or only of the `selected` switch names) are
+    instead parsed up front by a pool of `workers` processes. Either way the switches are sorted by name, the
+    order in which hosts are linked to the first port with their MAC (and the pipeline uses).
+    """
+    fns = sorted(glob("%s/*.json" % datadir))
+    eager = []
+    if workers > 1:
+        eager = [fn for fn in fns if selected is None or os.path.basename(fn)[: -len(".json")] in selected]
+    parsed = {}
+    if len(eager) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                partial(parse_snapshot, datadir, cachedir), eager, chunksize=max(1, len(eager) // (workers * 4))
+            )
+            for fn, (snapshot, worker_metrics) in zip(eager, results):
+                for metric in worker_metrics:
+                    metrics.add(metric["name"], metric["value"], **metric["labels"])
+                parsed[fn] = snapshot
+
+    switches = {}
+    for fn in fns:
+        if fn in parsed:
+            switch = LazySwitch(parsed[fn], datadir, cachedir)
+        else:
+            with open(fn, "rt") as fp:
+                switch = LazySwitch(json.load(fp), datadir, cachedir)
+        switches[switch["device_name"]] = switch
+
+    parse_cache.evict(cachedir)
     return switches
 
 
 def apply_config(device_name, device_options, lines):
+    """
+    Push `lines` to the device and save its configuration. Returns the device output.
+    Raises ValueError if the configuration cannot be saved on this device_type, so the device counts as failed.
+    """
     device_type = device_options["device_type"]
+    output = []
 
+    conn = Netmiko(**connect_options(device_options))
     try:
-        conn = Netmiko(**connect_options(device_options))
-        if device_type == 'hp_procurve':
-            lines = [line for line in lines if not line.strip().startswith('#')]
-        print(conn.send_config_set(lines))
+        if device_type == "hp_procurve":
+            lines = [line for line in lines if not line.strip().startswith("#")]
+        output.append(conn.send_config_set(lines))
         if device_type in ("cisco_ios", "cisco_nxos"):
-            print(conn.send_command("copy running-config startup-config"))
+            save_command = "copy running-config startup-config"
         elif device_type == "hp_comware":
-            print(conn.send_command("save main force"))
+            save_command = "save main force"
         elif device_type == "hp_procurve":
-            print(conn.send_command("write memory"))
+            save_command = "write memory"
         else:
-            print("ERROR: configuration not saved, as device_type %s is unhandled" % device_type)
+            raise ValueError(
+                "configuration applied but not saved, as device_type %s is unhandled:\n%s"
+                % (device_type, "\n".join(output))
+            )
+        output.append(conn.send_command(save_command, **send_command_options(device_options)))
     finally:
-        del conn
+        conn.disconnect()
+    return "\n".join(output)
@@ -0,0 +1,220 @@
+"""
+Benchmarks for parsing and configure, on synthetic fleets (see synthetic.py).
+
+    python3 -m switchportlabel.bench --switches 10 200 2000 --output bench.json
+    python3 -m switchportlabel.bench --switches 10 200 --compare bench.json
+
+Every parser and every configure phase is timed separately; the best of --repeat runs is reported.
+Results are written as JSON, and --compare reports timings that got slower than --threshold times
+the timings of an earlier result file.
+"""
+
+from glob import glob
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import acquire_puppetdb
+from . import acquire_switches
+from . import configure
+from . import configure_formatters
+from . import synthetic
+
+# Timings shorter than this are too noisy to be reported as regressions.
+MIN_SECONDS = 0.005
+
+
+def best_of(repeat, func, setup=None):
+    """Run func(setup()) `repeat` times, and return the shortest duration and the last result."""
+    best = None
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        result = func(arg)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, result
+
+
+def bench_parsers(datadir, repeat, timings):
+    snapshots = []
+    for fn in glob("%s/*.json" % datadir):
+        with open(fn, "rt") as fp:
+            snapshots.append(json.load(fp))
+
+    for datatype in acquire_switches.ACQUIRE_COMMANDS:
+        for device_type in sorted({switch["device_type"] for switch in snapshots}):
+            parse = getattr(acquire_switches, "parse_%s_%s" % (device_type, datatype), None)
+            if parse is None:
+                continue
+            raw = [
+                (switch["device_name"], acquire_switches.read_raw(datadir, switch, datatype))
+                for switch in snapshots
+                if switch["device_type"] == device_type
+            ]
+            timings["parse.%s.%s" % (device_type, datatype)], _ = best_of(
+                repeat, lambda _: [parse(device_name, text) for device_name, text in raw]
+            )
+
+
+def read_parsed_switches(switches_datadir):
+    """read_switches(), with all datatypes parsed up front, so configure timings do not include parsing."""
+    switches = acquire_switches.read_switches(switches_datadir, None)
+    for switch in switches.values():
+        for datatype in acquire_switches.ACQUIRE_COMMANDS:
+            switch[datatype]
+        switch["interface_aliases"]
+    return switches
+
+
+def bench_configure(datadir, repeat, timings, counts):
+    switches_datadir = os.path.join(datadir, "switches")
+    puppetdb_datadir = os.path.join(datadir, "puppetdb")
+
+    timings["read_switches"], switches = best_of(repeat, lambda _: read_parsed_switches(switches_datadir))
+    timings["read_facts"], hosts = best_of(repeat, lambda _: acquire_puppetdb.read_facts(puppetdb_datadir))
+    counts["interfaces"] = sum(len(switch["interfaces"]) for switch in switches.values())
+    counts["mactable_entries"] = sum(len(switch["mactable"]) for switch in switches.values())
+
+    # The steps of configure.configure(), timed one by one. Linking modifies the interfaces,
+    # so every run starts from freshly read switches.
+    def fresh_switches():
+        return read_parsed_switches(switches_datadir)
+
+    def indexed_switches():
+        switches = fresh_switches()
+        return switches, configure.index_mactable(switches)
+
+    def configured_switches():
+        return configure.configure(
+            fresh_switches(), hosts["fibrechannel"], hosts["ipmi"], hosts["lldp"], hosts["networking"]
+        )
+
+    phases = [
+        ("link_hosts_lldp", fresh_switches, lambda switches: configure.link_hosts_lldp(switches, hosts["lldp"])),
+        ("link_hosts_fc", fresh_switches, lambda switches: configure.link_hosts_fc(switches, hosts["fibrechannel"])),
+        ("index_mactable", fresh_switches, configure.index_mactable),
+        ("link_hosts_ipmi", indexed_switches, lambda s: configure.link_hosts_ipmi(s[0], hosts["ipmi"], s[1])),
+        (
+            "link_hosts_networking",
+            indexed_switches,
+            lambda s: configure.link_hosts_networking(s[0], hosts["networking"], s[1]),
+        ),
+        ("link_switches_lldp", fresh_switches, configure.link_switches_lldp),
+        (
+            "configure",
+            fresh_switches,
+            lambda switches: configure.configure(
+                switches, hosts["fibrechannel"], hosts["ipmi"], hosts["lldp"], hosts["networking"]
+            ),
+        ),
+        (
+            "format_for",
+            configured_switches,
+            lambda switches: [configure_formatters.format_for(switch) for switch in switches.values()],
+        ),
+    ]
+    for name, setup, func in phases:
+        timings["configure.%s" % name], result = best_of(repeat, func, setup)
+    counts["changed_ports"] = sum(len(linesets or []) for linesets in result)
+
+
+def run(sizes, ports, macs_per_port, repeat, keep_datadir=None):
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "ports": ports,
+        "macs_per_port": macs_per_port,
+        "fleets": {},
+    }
+    for switches in sizes:
+        with tempfile.TemporaryDirectory(prefix="switchportlabel-bench-") as tmpdir:
+            datadir = os.path.join(keep_datadir, str(switches)) if keep_datadir else tmpdir
+            print("Generating %d switches in %s" % (switches, datadir), file=sys.stderr)
+            counts = synthetic.generate_fleet(datadir, switches, ports, macs_per_port)
+            timings = {}
+            print("Benchmarking %d switches" % switches, file=sys.stderr)
+            # configure reports unmatched ports with print(), keep that out of the results
+            with open(os.devnull, "wt") as devnull, contextlib.redirect_stdout(devnull):
+                bench_parsers(os.path.join(datadir, "switches"), repeat, timings)
+                bench_configure(datadir, repeat, timings, counts)
+            results["fleets"][str(switches)] = {"timings": timings, "counts": counts}
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold):
+    """
+    Print old vs new timings; return False if any timing (of at least MIN_SECONDS) got slower
+    than `threshold` times the old one.
+    """
+    ok = True
+    print(
+        "%-8s %-40s %10s %10s %7s"
+        % ("switches", "timing", old.get("commit") or "old", new.get("commit") or "new", "ratio")
+    )
+    for size, fleet in new["fleets"].items():
+        old_timings = old["fleets"].get(size, {}).get("timings", {})
+        for name, seconds in sorted(fleet["timings"].items()):
+            if name not in old_timings:
+                continue
+            ratio = seconds / old_timings[name] if old_timings[name] else 1.0
+            flag = ""
+            if ratio > threshold and seconds >= MIN_SECONDS:
+                flag = " REGRESSION"
+                ok = False
+            print("%-8s %-40s %10.4f %10.4f %6.2fx%s" % (size, name, old_timings[name], seconds, ratio, flag))
+    return ok
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=args[0], description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--switches", type=int, nargs="+", default=[10, 200], help="fleet sizes (default: 10 200)")
+    parser.add_argument("--ports", type=int, default=48, help="Ethernet ports per switch (default: %(default)s)")
+    parser.add_argument(
+        "--macs-per-port", type=int, default=16, help="MACs on each hypervisor port (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per timing, the best is kept (default: %(default)s)"
+    )
+    parser.add_argument("--datadir", help="keep the generated data in this directory")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", metavar="RESULTS", help="compare with an earlier JSON results file")
+    parser.add_argument(
+        "--threshold", type=float, default=1.2, help="slowdown ratio reported as regression (default: %(default)s)"
+    )
+    options = parser.parse_args(args[1:])
+
+    results = run(options.switches, options.ports, options.macs_per_port, options.repeat, options.datadir)
+
+    if options.output:
+        with open(options.output, "wt") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare, "rt") as fp:
+            if not compare(json.load(fp), results, options.threshold):
+                sys.exit(1)
+    elif not options.output:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,88 @@
+"""
+Compact snapshot format (`--snapshot-format compact`), next to the default plain text and JSON files.
+
+Raw switch output is stored gzip-compressed. PuppetDB facts are stored as record files: a header, then blocks
+of about BLOCK_SIZE bytes of records, each block a 4-byte length followed by the zlib-compressed records as one
+JSON array. Records keep only the certname, name and value of a fact. Blocks are read and decoded one at a
+time, so reading never holds more than one block.
+
+The readers in acquire_switches and acquire_puppetdb handle both formats; `convert-snapshots` converts
+existing data directories.
+"""
+
+import gzip
+import json
+import struct
+import zlib
+
+FORMATS = ["text", "compact"]
+
+MAGIC = b"SWPLREC1"
+BLOCK_SIZE = 1 << 20
+BLOCK_LENGTH = struct.Struct(">I")
+
+# fact record fields read by acquire_puppetdb.FACT_READERS
+RECORD_FIELDS = ("certname", "name", "value")
+
+
+def read_text(fn):
+    """Contents of a text file, gzip-compressed if `fn` ends with .gz."""
+    if fn.endswith(".gz"):
+        with gzip.open(fn, "rt") as fp:
+            return fp.read()
+    with open(fn, "rt") as fp:
+        return fp.read()
+
+
+def write_text(fn, text, compress):
+    if compress:
+        with gzip.open(fn, "wt", compresslevel=6) as fp:
+            fp.write(text)
+    else:
+        with open(fn, "wt") as fp:
+            fp.write(text)
+
+
+def write_block(fp, encoded):
+    data = zlib.compress(("[%s]" % ",".join(encoded)).encode(), 6)
+    fp.write(BLOCK_LENGTH.pack(len(data)))
+    fp.write(data)
+
+
+def write_records(fn, records):
+    """Write the fact `records` (dicts with RECORD_FIELDS) to the record file `fn`. Returns the number written."""
+    count = 0
+    with open(fn, "wb") as fp:
+        fp.write(MAGIC)
+        encoded = []
+        size = 0
+        for record in records:
+            encoded.append(json.dumps([record[field] for field in RECORD_FIELDS], separators=(",", ":")))
+            size += len(encoded[-1])
+            count += 1
+            if size >= BLOCK_SIZE:
+                write_block(fp, encoded)
+                encoded = []
+                size = 0
+        if encoded:
+            write_block(fp, encoded)
+    return count
+
+
+def iter_records(fn):
+    """Yield the fact records of the record file `fn`, as dicts with RECORD_FIELDS."""
+    with open(fn, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a snapshot record file" % fn)
+        while True:
+            header = fp.read(BLOCK_LENGTH.size)
+            if not header:
+                return
+            if len(header) != BLOCK_LENGTH.size:
+                raise ValueError("%s is truncated" % fn)
+            (length,) = BLOCK_LENGTH.unpack(header)
+            data = fp.read(length)
+            if len(data) < length:
+                raise ValueError("%s is truncated" % fn)
+            for values in json.loads(zlib.decompress(data)):
+                yield dict(zip(RECORD_FIELDS, values))
@@ -1,23 +1,23 @@
 import itertools
 
+from . import metrics
+from . import profiling
+
 
 def set_port_attr(switches, switchname, switchport, attr, value, overwrite=False):
     if switchname not in switches:
         print("I: switch", switchname, "not configured, ignoring")
         return
-    if switchport not in switches[switchname]["interfaces"]:
-        switchport_alias = None
-        for switchport_real, iface in switches[switchname]["interfaces"].items():
-            if switchport in iface['switchport_aliases']:
-                switchport_alias = switchport_real
-                break
+    interfaces = switches[switchname]["interfaces"]
+    if switchport not in interfaces:
+        switchport_alias = switches[switchname]["interface_aliases"].get(switchport, None)
         if switchport_alias:
             switchport = switchport_alias
         else:
             print("I: switch", switchname, "port", switchport, "not found, ignoring")
             return
-    if overwrite or attr not in switches[switchname]["interfaces"][switchport]:
-        switches[switchname]["interfaces"][switchport][attr] = value
+    if overwrite or attr not in interfaces[switchport]:
+        interfaces[switchport][attr] = value
 
 
 def format_description(switchport):
@@ -54,81 +54,223 @@ def format_description(switchport):
     return desc
 
 
-def link_hosts_fc(switches, hosts_fc):
+def normalize_wwpn(wwpn):
+    wwpn = wwpn.lower().replace(":", "")
+    if wwpn.startswith("0x"):
+        wwpn = wwpn[2:]
+    return wwpn
+
+
+def index_flogi(switches):
+    """Map normalized WWPN -> list of (switchname, flogi row), in switch order."""
+    by_wwpn = {}
+    for switchname, switch in switches.items():
+        for row in switch["flogi"]:
+            by_wwpn.setdefault(normalize_wwpn(row["port_name"]), []).append((switchname, row))
+    return by_wwpn
+
+
+@metrics.timed("configure_phase", phase="link_hosts_fc")
+def link_hosts_fc(switches, hosts_fc, db=None, selected=None):
+    if not hosts_fc:
+        # no need to read the flogi data of all switches
+        return
+    if db is not None:
+        from . import snapshot_db
+
+        flogi_index = snapshot_db.index_flogi(db, switches)
+    else:
+        flogi_index = index_flogi(switches)
     for hostname, hosts in hosts_fc.items():
         for host_id, detail in hosts.items():
-            port_name = detail["port_name"]
-            for switchname, switch in switches.items():
-                for row in switch["flogi"]:
-                    if row["port_name"] == port_name:
-                        set_port_attr(switches, switchname, row["switchport"], "hostname", hostname, True)
-                        set_port_attr(switches, switchname, row["switchport"], "hostport", host_id, True)
+            logins = flogi_index.get(normalize_wwpn(detail["port_name"]), [])
+            if len(logins) > 1:
+                print(
+                    "W: WWPN",
+                    detail["port_name"],
+                    "of",
+                    hostname,
+                    host_id,
+                    "logged in on multiple ports:",
+                    ", ".join("%s %s" % (switchname, row["switchport"]) for switchname, row in logins),
+                )
+            for switchname, row in logins:
+                if selected is not None and switchname not in selected:
+                    continue
+                set_port_attr(switches, switchname, row["switchport"], "hostname", hostname, True)
+                set_port_attr(switches, switchname, row["switchport"], "hostport", host_id, True)
 
 
+@metrics.timed("configure_phase", phase="link_hosts_lldp")
 def link_hosts_lldp(switches, hosts_lldp):
     for iface in hosts_lldp:
         set_port_attr(switches, iface["switchname"], iface["switchport"], "hostname", iface["hostname"], True)
         set_port_attr(switches, iface["switchname"], iface["switchport"], "hostport", iface["hostport"], True)
 
 
-def find_unique_mac(switches, mac):
-    all_macs = [
-        mac_entry for switch in switches.values() for mac_entry in switch["mactable"] if mac_entry["address"] == mac
-    ]
-    for maybe_entry in all_macs:
-        macs = [
-            mac_entry
-            for mac_entry in switches[maybe_entry["switchname"]]["mactable"]
-            if mac_entry["switchport"] == maybe_entry["switchport"]
-        ]
-        if len(macs) == 1:
-            return macs[0]
+@metrics.timed("configure_phase", phase="index_mactable")
+def index_mactable(switches):
+    """
+    Build the lookup structures for find_unique_mac: address -> mactable entries (in switch order),
+    and (switchname, switchport) -> number of mactable entries on that port.
+    """
+    by_address = {}
+    port_counts = {}
+    for switch in switches.values():
+        for mac_entry in switch["mactable"]:
+            by_address.setdefault(mac_entry["address"], []).append(mac_entry)
+            port = (mac_entry["switchname"], mac_entry["switchport"])
+            port_counts[port] = port_counts.get(port, 0) + 1
+    return {"by_address": by_address, "port_counts": port_counts}
+
+
+def find_unique_mac(mac_index, mac):
+    for maybe_entry in mac_index["by_address"].get(mac, []):
+        if mac_index["port_counts"][(maybe_entry["switchname"], maybe_entry["switchport"])] == 1:
+            return maybe_entry
     return None
 
 
-def link_hosts_ipmi(switches, hosts_ipmi):
+@metrics.timed("configure_phase", phase="link_hosts_ipmi")
+def link_hosts_ipmi(switches, hosts_ipmi, mac_index, selected=None):
     for hostname, ifaces in hosts_ipmi.items():
         for host_iface in ifaces:
             if host_iface.get("mac", None) is None:
                 print("I: host_iface has no mac", hostname, host_iface)
                 continue
-            iface = find_unique_mac(switches, host_iface["mac"])
-            if iface:
+            iface = find_unique_mac(mac_index, host_iface["mac"])
+            if iface and (selected is None or iface["switchname"] in selected):
                 set_port_attr(switches, iface["switchname"], iface["switchport"], "hostname", hostname)
                 set_port_attr(switches, iface["switchname"], iface["switchport"], "hostport", "lom")
 
 
-def link_hosts_networking(switches, hosts_networking):
+@metrics.timed("configure_phase", phase="link_hosts_networking")
+def link_hosts_networking(switches, hosts_networking, mac_index, selected=None):
     for hostname, ifaces in hosts_networking.items():
         for host_iface_name, host_iface in ifaces.items():
-            iface = find_unique_mac(switches, host_iface["mac"])
-            if iface:
+            iface = find_unique_mac(mac_index, host_iface["mac"])
+            if iface and (selected is None or iface["switchname"] in selected):
                 set_port_attr(switches, iface["switchname"], iface["switchport"], "hostname", hostname)
                 set_port_attr(switches, iface["switchname"], iface["switchport"], "hostport", host_iface_name)
 
 
-def link_switches_lldp(switches):
-    for switchname in switches:
-        for iface in switches[switchname]["lldp"]:
+@metrics.timed("configure_phase", phase="link_switches_lldp")
+def link_switches_lldp(switches, selected=None):
+    """
+    Link switch ports seen via LLDP, from both ends: a port is also linked when only the switch on the other
+    end reports it. With `selected` switch names, only ports of the selected switches are set.
+    """
+    for switchname, switch in switches.items():
+        for iface in switch["lldp"]:
             if iface["hostname"] in switches:
-                set_port_attr(switches, switchname, iface["switchport"], "remote_switchname", iface["hostname"])
-                set_port_attr(switches, switchname, iface["switchport"], "remote_switchport", iface["hostport"])
-                set_port_attr(switches, iface["hostname"], iface["hostport"], "remote_switchname", switchname)
-                set_port_attr(switches, iface["hostname"], iface["hostport"], "remote_switchport", iface["switchport"])
-
+                if selected is None or switchname in selected:
+                    set_port_attr(switches, switchname, iface["switchport"], "remote_switchname", iface["hostname"])
+                    set_port_attr(switches, switchname, iface["switchport"], "remote_switchport", iface["hostport"])
+                if selected is None or iface["hostname"] in selected:
+                    set_port_attr(switches, iface["hostname"], iface["hostport"], "remote_switchname", switchname)
+                    set_port_attr(
+                        switches, iface["hostname"], iface["hostport"], "remote_switchport", iface["switchport"]
+                    )
 
-def configure(switches, hosts_fc, hosts_ipmi, hosts_lldp, hosts_networking):
-    link_hosts_lldp(switches, hosts_lldp)
-    link_hosts_fc(switches, hosts_fc)
-    link_hosts_ipmi(switches, hosts_ipmi)
-    link_hosts_networking(switches, hosts_networking)
-    link_switches_lldp(switches)
 
+@metrics.timed("configure_phase", phase="format_description")
+def set_new_descriptions(switches, selected_hosts=None):
     for switchname, switch in switches.items():
         for portname, detail in switch["interfaces"].items():
             if portname == "mgmt0":
                 # Ignore management port, the LLDP info is probably not that good.
                 continue
+            if selected_hosts is not None and detail.get("hostname") not in selected_hosts:
+                continue
             detail["new_description"] = format_description(detail)
 
+
+def count_linked_ports(switches):
+    for switchname, switch in switches.items():
+        host_ports = sum(1 for detail in switch["interfaces"].values() if "hostname" in detail)
+        switch_ports = sum(1 for detail in switch["interfaces"].values() if "remote_switchname" in detail)
+        metrics.add("linked_ports", host_ports, device=switchname, kind="host")
+        metrics.add("linked_ports", switch_ports, device=switchname, kind="switch")
+
+
+def parse_datatypes(switches, datatypes):
+    """Access `datatypes` of all switches, so lazily parsed snapshots are parsed before linking starts."""
+    for switch in switches.values():
+        for datatype in datatypes:
+            switch[datatype]
+
+
+def host_macs(hosts_ipmi, hosts_networking):
+    macs = set()
+    for ifaces in hosts_ipmi.values():
+        macs.update(host_iface["mac"] for host_iface in ifaces if host_iface.get("mac", None) is not None)
+    for ifaces in hosts_networking.values():
+        macs.update(host_iface["mac"] for host_iface in ifaces.values())
+    return sorted(macs)
+
+
+def configure(
+    switches,
+    hosts_fc,
+    hosts_ipmi,
+    hosts_lldp,
+    hosts_networking,
+    columnar=False,
+    selected=None,
+    selected_hosts=None,
+    db=None,
+):
+    """
+    Link hosts and switches to switch ports, and compute the new port descriptions.
+
+    With a snapshot database connection `db` (see snapshot_db), the FLOGI and mactable lookups are indexed
+    joins in the database instead of indexes built from all switches.
+
+    With `selected` switch names, only the ports of those switches are linked and get new descriptions; selected
+    names without a snapshot are ignored. With `selected_hosts` names, only ports linked to one of those hosts get
+    new descriptions. Either way the indexes are built from all switches and hosts, so these ports get the same
+    descriptions as in a full run.
+    """
+    if selected is not None:
+        selected = set(selected) & set(switches)
+    scoped = switches if selected is None else {name: switch for name, switch in switches.items() if name in selected}
+    if selected is not None:
+        hosts_lldp = [iface for iface in hosts_lldp if iface["switchname"] in scoped]
+
+    # parse first, so the link timings and profile do not include parsing; the columnar mactable is built
+    # while the mactables are parsed, one switch at a time
+    parse_datatypes(scoped, ["interfaces"])
+    datatypes = []
+    if hosts_fc and db is None:
+        datatypes.append("flogi")
+    if db is None and not columnar:
+        datatypes.append("mactable")
+    if selected_hosts is None:
+        datatypes.append("lldp")
+    parse_datatypes(switches, datatypes)
+
+    with profiling.phase("link"):
+        link_hosts_lldp(scoped, hosts_lldp)
+        link_hosts_fc(switches, hosts_fc, db, selected)
+        if db is not None:
+            from . import snapshot_db
+
+            with metrics.timed("configure_phase", phase="index_mactable_db"):
+                mac_index = snapshot_db.index_mactable(db, switches)
+        elif columnar:
+            from . import mactable_columnar
+
+            with metrics.timed("configure_phase", phase="index_mactable_columnar"):
+                mac_index = mactable_columnar.index_mactable(switches, host_macs(hosts_ipmi, hosts_networking))
+        else:
+            mac_index = index_mactable(switches)
+        link_hosts_ipmi(switches, hosts_ipmi, mac_index, selected)
+        link_hosts_networking(switches, hosts_networking, mac_index, selected)
+        if selected_hosts is None:
+            link_switches_lldp(switches, selected)
+
+    with profiling.phase("format"):
+        set_new_descriptions(scoped, selected_hosts)
+    count_linked_ports(scoped)
+
     return switches
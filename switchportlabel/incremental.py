@@ -0,0 +1,271 @@
+"""
+Incremental configure (--incremental). The state of the previous run keeps, per switch, a fingerprint of its
+snapshot, what links on other switches depend on (single-MAC mactable ports, FLOGI WWPNs, LLDP neighbors) and
+its rendered configuration; and per host a digest of its facts and the MACs, WWPNs or switches they refer to.
+
+A run compares the current snapshots and facts with that state, and only links, describes and renders the
+switches whose ports can be affected by the changes. All other switches keep their previous output, without
+their snapshots even being parsed. --verify-incremental also does a full run and compares both.
+"""
+
+import hashlib
+import json
+import os
+
+from . import acquire_switches
+from . import compact
+from . import configure
+from . import metrics
+from . import profiling
+
+STATE_VERSION = 2
+
+
+def digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def switch_fingerprint(datadir, switch):
+    """Digest of the device info of a snapshot and of the size and modification time of its files."""
+    info = {
+        key: value
+        for key, value in switch.items()
+        if key not in acquire_switches.ACQUIRE_COMMANDS and key != "interface_aliases" and not key.startswith("raw_")
+    }
+    files = [acquire_switches.snapshot_filename(datadir, switch["device_name"])]
+    for snapshot_format in compact.FORMATS:
+        files.extend(acquire_switches.snapshot_filenames(datadir, switch["device_name"], snapshot_format)[1:])
+    stats = []
+    for fn in files:
+        try:
+            st = os.stat(fn)
+        except FileNotFoundError:
+            continue
+        stats.append([os.path.basename(fn), st.st_size, st.st_mtime_ns])
+    return digest([info, stats])
+
+
+def switch_summary(switch):
+    """What the links of other switches' ports depend on: single-MAC mactable ports, FLOGI WWPNs, LLDP."""
+    port_counts = {}
+    for mac_entry in switch["mactable"]:
+        port = (mac_entry["switchname"], mac_entry["switchport"])
+        port_counts[port] = port_counts.get(port, 0) + 1
+    return {
+        "single_macs": [
+            [mac_entry["address"], mac_entry["switchname"], mac_entry["switchport"]]
+            for mac_entry in switch["mactable"]
+            if port_counts[(mac_entry["switchname"], mac_entry["switchport"])] == 1
+        ],
+        "wwpns": sorted({configure.normalize_wwpn(row["port_name"]) for row in switch["flogi"]}),
+        "lldp": [[iface["switchport"], iface["hostname"], iface["hostport"]] for iface in switch["lldp"]],
+    }
+
+
+def host_records(hosts):
+    """Per fact and host (in fact order): [digest of the host's facts, the WWPNs, MACs or switches they refer to]."""
+    lldp = {}
+    for iface in hosts["lldp"]:
+        lldp.setdefault(iface["hostname"], []).append(iface)
+    return {
+        "fibrechannel": {
+            hostname: [digest(fc_hosts), sorted({configure.normalize_wwpn(d["port_name"]) for d in fc_hosts.values()})]
+            for hostname, fc_hosts in hosts["fibrechannel"].items()
+        },
+        "ipmi": {
+            hostname: [digest(ifaces), sorted({i["mac"] for i in ifaces if i.get("mac", None) is not None})]
+            for hostname, ifaces in hosts["ipmi"].items()
+        },
+        "lldp": {
+            hostname: [digest(ifaces), sorted({iface["switchname"] for iface in ifaces})]
+            for hostname, ifaces in lldp.items()
+        },
+        "networking": {
+            hostname: [digest(ifaces), sorted({i["mac"] for i in ifaces.values()})]
+            for hostname, ifaces in hosts["networking"].items()
+        },
+    }
+
+
+def resolve_macs(summaries, macs):
+    """configure.find_unique_mac for all `macs`: MAC -> [switchname, switchport], from the switch summaries."""
+    ports = {}
+    for summary in summaries.values():
+        for address, switchname, switchport in summary["single_macs"]:
+            if address in macs and address not in ports:
+                ports[address] = [switchname, switchport]
+    return ports
+
+
+def read_state(fn):
+    try:
+        with open(fn, "rt") as fp:
+            state = json.load(fp)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        print("W: ignoring unreadable incremental state", fn)
+        return None
+    if state.get("version") != [STATE_VERSION, acquire_switches.PARSER_VERSION]:
+        return None
+    return state
+
+
+def write_state(fn, state):
+    with open(fn + ".tmp", "wt") as fp:
+        json.dump(state, fp)
+    os.replace(fn + ".tmp", fn)
+
+
+def changed_hosts(old_records, records):
+    """
+    Per fact, the hosts whose facts changed (or were added or removed). None if the order of the unchanged
+    hosts changed, which can change which host wins a port.
+    """
+    changed = {}
+    for fact_name, fact_records in records.items():
+        old_fact_records = old_records.get(fact_name, {})
+        changed[fact_name] = {
+            hostname
+            for hostname in set(fact_records) | set(old_fact_records)
+            if fact_records.get(hostname, [None])[0] != old_fact_records.get(hostname, [None])[0]
+        }
+        if [h for h in fact_records if h not in changed[fact_name]] != [
+            h for h in old_fact_records if h not in changed[fact_name]
+        ]:
+            return None
+    return changed
+
+
+def affected_switches(state, switches, fingerprints, summaries, records, mac_ports):
+    """The switches whose ports can link or render differently than in the previous run, or None for all."""
+    if state is None:
+        return None
+    old_switches = state["switches"]
+    changed = {name for name in switches if old_switches.get(name, {}).get("fingerprint") != fingerprints[name]}
+    removed = set(old_switches) - set(switches)
+    affected = set(changed)
+
+    # switch LLDP: neighbors of changed, added or removed switches, and switches that have them as neighbor
+    for name in changed | removed:
+        for summary in (old_switches.get(name, {}).get("summary"), summaries.get(name)):
+            if summary is not None:
+                affected.update(hostname for _, hostname, _ in summary["lldp"])
+    for name, summary in summaries.items():
+        if any(hostname in changed | removed for _, hostname, _ in summary["lldp"]):
+            affected.add(name)
+
+    hosts = changed_hosts(state["hosts"], records)
+    if hosts is None:
+        return None
+    old_records = state["hosts"]
+
+    def referenced(fact_name):
+        keys = set()
+        for hostname in hosts[fact_name]:
+            for fact_records in (old_records.get(fact_name, {}), records[fact_name]):
+                keys.update(fact_records.get(hostname, [None, []])[1])
+        return keys
+
+    affected.update(referenced("lldp"))
+    wwpns = referenced("fibrechannel")
+    affected.update(name for name, summary in summaries.items() if wwpns.intersection(summary["wwpns"]))
+    # MACs of changed hosts, and MACs found on another port than before
+    old_mac_ports = state["mac_ports"]
+    macs = referenced("ipmi") | referenced("networking")
+    macs.update(mac for mac in set(mac_ports) | set(old_mac_ports) if mac_ports.get(mac) != old_mac_ports.get(mac))
+    for mac in macs:
+        for port in (mac_ports.get(mac), old_mac_ports.get(mac)):
+            if port is not None:
+                affected.add(port[0])
+
+    return affected & set(switches)
+
+
+@metrics.timed("configure_phase", phase="link_switches_lldp")
+def link_switches_lldp(scoped, switches, summaries):
+    """configure.link_switches_lldp for the ports of the `scoped` switches, from the LLDP summaries of all switches."""
+    for switchname, summary in summaries.items():
+        for switchport, hostname, hostport in summary["lldp"]:
+            if hostname in switches:
+                if switchname in scoped:
+                    configure.set_port_attr(scoped, switchname, switchport, "remote_switchname", hostname)
+                    configure.set_port_attr(scoped, switchname, switchport, "remote_switchport", hostport)
+                if hostname in scoped:
+                    configure.set_port_attr(scoped, hostname, hostport, "remote_switchname", switchname)
+                    configure.set_port_attr(scoped, hostname, hostport, "remote_switchport", switchport)
+
+
+def configure_incremental(datadir, switches, hosts, state_fn, render):
+    """
+    Link and describe the ports of `switches` (as returned by acquire_switches.read_switches(datadir), not yet parsed)
+    like configure.configure, reusing the state of the previous run in `state_fn`. Returns switch name ->
+    rendered lines (`render(switchname, switch)`) for all switches, and writes the new state.
+    """
+    state = read_state(state_fn)
+    old_switches = state["switches"] if state is not None else {}
+    fingerprints = {name: switch_fingerprint(datadir, switch) for name, switch in switches.items()}
+    summaries = {}
+    with metrics.timed("configure_phase", phase="incremental_summaries"):
+        for name, switch in switches.items():
+            if old_switches.get(name, {}).get("fingerprint") == fingerprints[name]:
+                summaries[name] = old_switches[name]["summary"]
+            else:
+                summaries[name] = switch_summary(switch)
+    records = host_records(hosts)
+    mac_ports = resolve_macs(summaries, set(configure.host_macs(hosts["ipmi"], hosts["networking"])))
+
+    affected = affected_switches(state, switches, fingerprints, summaries, records, mac_ports)
+    if affected is None:
+        print("I: no usable incremental state, configuring all switches")
+        affected = set(switches)
+    print("I: configuring", len(affected), "of", len(switches), "switches incrementally")
+    metrics.add("incremental_switches", len(affected))
+    scoped = {name: switch for name, switch in switches.items() if name in affected}
+    configure.parse_datatypes(scoped, ["interfaces", "flogi"])
+
+    with profiling.phase("link"):
+        configure.link_hosts_lldp(scoped, [iface for iface in hosts["lldp"] if iface["switchname"] in scoped])
+        configure.link_hosts_fc(scoped, hosts["fibrechannel"])
+        mac_index = {"by_address": {}, "port_counts": {}}
+        for mac, (switchname, switchport) in mac_ports.items():
+            if switchname in scoped:
+                mac_index["by_address"][mac] = [{"address": mac, "switchname": switchname, "switchport": switchport}]
+                mac_index["port_counts"][(switchname, switchport)] = 1
+        configure.link_hosts_ipmi(scoped, hosts["ipmi"], mac_index)
+        configure.link_hosts_networking(scoped, hosts["networking"], mac_index)
+        link_switches_lldp(scoped, switches, summaries)
+
+    with profiling.phase("format"):
+        configure.set_new_descriptions(scoped)
+    configure.count_linked_ports(scoped)
+
+    rendered = {}
+    for name, switch in switches.items():
+        rendered[name] = render(name, switch) if name in scoped else old_switches[name]["lines"]
+
+    write_state(
+        state_fn,
+        {
+            "version": [STATE_VERSION, acquire_switches.PARSER_VERSION],
+            "switches": {
+                name: {"fingerprint": fingerprints[name], "summary": summaries[name], "lines": rendered[name]}
+                for name in switches
+            },
+            "hosts": records,
+            "mac_ports": mac_ports,
+        },
+    )
+    return rendered
+
+
+def verify(rendered, full_rendered, state_fn):
+    """Compare the incremental output with a full run; on a difference, drop the state so the next run is full."""
+    differing = [name for name in set(rendered) | set(full_rendered) if rendered.get(name) != full_rendered.get(name)]
+    for name in sorted(differing):
+        print("E: incremental configuration of", name, "differs from a full run")
+    if differing:
+        os.unlink(state_fn)
+        return False
+    print("I: incremental configuration of", len(rendered), "switches matches a full run")
+    return True
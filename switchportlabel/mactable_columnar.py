@@ -0,0 +1,93 @@
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .acquire_switches import LazySwitch
+
+
+def build_columnar_mactable(switches):
+    """
+    Collect the mactables of all switches into columns: addresses as uint64, and switch port and VLAN
+    as integer codes into the interned `ports` ((switchname, switchport) tuples) and `vlans` lists.
+    Addresses that are not 12 lowercase hex digits are marked as not `valid` and never match.
+
+    The columns are built in compact arrays, one switch at a time. The parsed rows of a LazySwitch are
+    dropped once they are in the columns (they are parsed again, from the parse cache, if used later), so
+    the full fleet never exists as dict rows at once.
+    """
+    if numpy is None:
+        raise RuntimeError("the columnar mactable needs numpy: pip3 install numpy")
+
+    port_codes = {}
+    vlan_codes = {}
+    addresses = array("Q")
+    valid = array("B")
+    ports = array("i")
+    vlans = array("i")
+    for switch in switches.values():
+        loaded = "mactable" in switch
+        for mac_entry in switch["mactable"]:
+            address = mac_to_int(mac_entry["address"])
+            addresses.append(address or 0)
+            valid.append(address is not None)
+            ports.append(port_codes.setdefault((mac_entry["switchname"], mac_entry["switchport"]), len(port_codes)))
+            vlans.append(vlan_codes.setdefault(mac_entry["vlan"], len(vlan_codes)))
+        if not loaded and isinstance(switch, LazySwitch):
+            del switch["mactable"]
+
+    return {
+        "address": numpy.frombuffer(addresses, dtype=numpy.uint64),
+        "valid": numpy.frombuffer(valid, dtype=numpy.uint8).astype(bool),
+        "port": numpy.frombuffer(ports, dtype=numpy.int32),
+        "vlan": numpy.frombuffer(vlans, dtype=numpy.int32),
+        "ports": list(port_codes),
+        "vlans": list(vlan_codes),
+    }
+
+
+def mac_to_int(mac):
+    if len(mac) != 12 or mac != mac.lower():
+        return None
+    try:
+        return int(mac, 16)
+    except ValueError:
+        return None
+
+
+def find_unique_macs(table, macs):
+    """
+    Vectorized find_unique_mac for many MACs at once: for each MAC return the (switchname, switchport)
+    of the first entry (in switch and mactable order) on a port with exactly one MAC, or None.
+    """
+    port_counts = numpy.bincount(table["port"], minlength=len(table["ports"]))
+    rows = numpy.flatnonzero((port_counts[table["port"]] == 1) & table["valid"])
+    # A stable sort keeps entries for the same MAC in their original order, so searchsorted finds the first one.
+    rows = rows[numpy.argsort(table["address"][rows], kind="stable")]
+    sorted_addresses = table["address"][rows]
+
+    wanted = [mac_to_int(mac) for mac in macs]
+    wanted_valid = numpy.array([address is not None for address in wanted], dtype=bool)
+    wanted = numpy.array([address or 0 for address in wanted], dtype=numpy.uint64)
+    pos = numpy.searchsorted(sorted_addresses, wanted, side="left")
+    found = wanted_valid & (pos < len(sorted_addresses))
+    found[found] = sorted_addresses[pos[found]] == wanted[found]
+
+    return [table["ports"][table["port"][rows[p]]] if ok else None for p, ok in zip(pos.tolist(), found.tolist())]
+
+
+def index_mactable(switches, macs):
+    """
+    Resolve `macs` with find_unique_macs and return the result in the shape of configure.index_mactable,
+    so find_unique_mac can be used unchanged.
+    """
+    table = build_columnar_mactable(switches)
+    by_address = {}
+    port_counts = {}
+    for mac, port in zip(macs, find_unique_macs(table, macs)):
+        if port is not None:
+            by_address[mac] = [{"address": mac, "switchname": port[0], "switchport": port[1]}]
+            port_counts[port] = 1
+    return {"by_address": by_address, "port_counts": port_counts}
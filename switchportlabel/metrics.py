@@ -0,0 +1,72 @@
+"""
+Run metrics: durations, bytes and counts, labelled e.g. by device or phase, and collected for the whole run.
+Exported as a JSON report or as a Prometheus textfile-collector file.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+PREFIX = "switchportlabel_"
+
+_lock = threading.Lock()
+_values = {}
+
+
+def add(name, value, **labels):
+    """Add `value` to the metric `name` with the given labels."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+
+@contextmanager
+def timed(name, **labels):
+    """Add the duration of the with-block to the metric `name`_seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name + "_seconds", time.perf_counter() - start, **labels)
+
+
+def reset():
+    with _lock:
+        _values.clear()
+
+
+def collect():
+    with _lock:
+        return [
+            {"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(_values.items())
+        ]
+
+
+def write_atomically(fn, text):
+    with open(fn + ".tmp", "wt") as fp:
+        fp.write(text)
+    os.replace(fn + ".tmp", fn)
+
+
+def write_json(fn):
+    write_atomically(fn, json.dumps({"generated_at": time.time(), "metrics": collect()}, indent=2) + "\n")
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write_prometheus(fn):
+    """Write all metrics in the Prometheus text format, e.g. for the node_exporter textfile collector."""
+    lines = []
+    last_name = None
+    for metric in collect():
+        name = PREFIX + metric["name"]
+        if name != last_name:
+            lines.append("# TYPE %s gauge" % name)
+            last_name = name
+        labels = ",".join('%s="%s"' % (k, escape_label_value(v)) for k, v in sorted(metric["labels"].items()))
+        lines.append("%s%s %s" % (name, "{%s}" % labels if labels else "", repr(float(metric["value"]))))
+    write_atomically(fn, "\n".join(lines) + "\n")
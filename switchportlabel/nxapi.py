@@ -0,0 +1,148 @@
+"""
+NX-API transport for Cisco NX-OS: all show commands of a switch in one JSON-RPC request, answered with
+structured JSON instead of CLI text. Requires `feature nxapi` on the switch and `transport=nxapi` in
+data/switches.ini.
+
+Connections are kept alive and reused for further requests to the same switch (e.g. retries), until close().
+"""
+
+import base64
+import http.client
+import json
+import ssl
+import threading
+
+from . import metrics
+
+NXAPI_COMMANDS = {
+    "interfaces": "show interface",
+    "flogi": "show flogi database",
+    "lldp": "show lldp neighbors detail",
+    "mactable": "show mac address-table dynamic",
+}
+
+# Datatypes whose command fails on some switches (flogi without FC/FCoE); an error there leaves the datatype
+# empty, as over SSH, instead of failing the whole switch
+OPTIONAL_DATATYPES = {"flogi"}
+
+_lock = threading.Lock()
+_connections = {}
+
+
+class NxapiError(Exception):
+    pass
+
+
+def endpoint(device_options):
+    scheme = device_options.get("nxapi_scheme", "https")
+    port = int(device_options.get("nxapi_port", 443 if scheme == "https" else 80))
+    return scheme, device_options["ip"], port
+
+
+def connection(device_options):
+    """Return the kept-alive connection for the device, creating it if needed."""
+    key = endpoint(device_options)
+    scheme, host, port = key
+    timeout = float(device_options.get("command_timeout", 120))
+    with _lock:
+        conn = _connections.get(key)
+        if conn is None:
+            if scheme == "https":
+                context = ssl.create_default_context()
+                if device_options.get("verify_tls", "yes").lower() not in ("yes", "true", "on", "1"):
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                conn = http.client.HTTPSConnection(host, port, timeout=timeout, context=context)
+            else:
+                conn = http.client.HTTPConnection(host, port, timeout=timeout)
+            _connections[key] = conn
+    return conn
+
+
+def close(device_options):
+    with _lock:
+        conn = _connections.pop(endpoint(device_options), None)
+    if conn is not None:
+        conn.close()
+
+
+def request_body(commands):
+    return json.dumps(
+        [
+            {"jsonrpc": "2.0", "method": "cli", "params": {"cmd": command, "version": 1}, "id": i + 1}
+            for i, command in enumerate(commands)
+        ]
+    )
+
+
+def post(device_options, body):
+    auth = base64.b64encode(("%s:%s" % (device_options["username"], device_options["password"])).encode()).decode()
+    headers = {"Content-Type": "application/json-rpc", "Authorization": "Basic %s" % auth}
+    for attempt in range(2):
+        conn = connection(device_options)
+        try:
+            conn.request("POST", "/ins", body, headers)
+            response = conn.getresponse()
+            data = response.read()
+            break
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            # the switch closed the kept-alive connection, reconnect once
+            close(device_options)
+            if attempt:
+                raise
+        except Exception:
+            close(device_options)
+            raise
+    return response, data
+
+
+def run_commands(device_name, device_options, commands, optional=()):
+    """
+    Run all `commands` in one request. Returns the JSON body of every command, in order. A failing command
+    raises NxapiError, unless it is in `optional`, which gives it an empty body.
+    """
+    with metrics.timed("acquire_nxapi_request", device=device_name):
+        response, data = post(device_options, request_body(commands))
+    metrics.add("acquire_received_bytes", len(data), device=device_name, datatype="nxapi")
+
+    # failing commands are reported with HTTP status 500 and a JSON-RPC error
+    try:
+        results = json.loads(data)
+    except ValueError:
+        results = None
+    if not isinstance(results, (dict, list)):
+        raise NxapiError("HTTP %d %s" % (response.status, response.reason))
+    if isinstance(results, dict):
+        # a batch of one command is answered with a single object
+        results = [results]
+    results = {result.get("id"): result for result in results}
+
+    bodies = []
+    for i, command in enumerate(commands):
+        result = results.get(i + 1)
+        if result is None:
+            raise NxapiError("no response for %r" % command)
+        if "error" in result:
+            error = result["error"]
+            message = "%r failed: %s" % (command, (error.get("data") or {}).get("msg", error.get("message")))
+            if command not in optional:
+                raise NxapiError(message)
+            print("I:", device_name, message)
+            bodies.append({})
+            continue
+        # commands with empty output (e.g. no flogi entries) return no body
+        bodies.append((result.get("result") or {}).get("body") or {})
+    return bodies
+
+
+def acquire(device_name, device_options):
+    """Fetch all datatypes, returned as raw_<datatype> JSON texts for the parse_cisco_nxos_nxapi_* functions."""
+    print("Requesting NX-API of", device_name)
+    datatypes = list(NXAPI_COMMANDS)
+    bodies = run_commands(
+        device_name,
+        device_options,
+        [NXAPI_COMMANDS[datatype] for datatype in datatypes],
+        {NXAPI_COMMANDS[datatype] for datatype in OPTIONAL_DATATYPES},
+    )
+    return {"raw_%s" % datatype: json.dumps(body) for datatype, body in zip(datatypes, bodies)}
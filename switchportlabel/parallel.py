@@ -0,0 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def iter_parallel(func, items, workers):
+    """
+    Call func(name, value) for every item of the dict `items`, running at most `workers` calls at once.
+    Yields (name, result, exception) as soon as each call is done, so the caller can work on it meanwhile.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(func, name, value): name for name, value in items.items()}
+        for future in as_completed(futures):
+            try:
+                result, exc = future.result(), None
+            except Exception as e:
+                result, exc = None, e
+            yield futures[future], result, exc
+
+
+def run_parallel(func, items, workers):
+    """
+    Call func(name, value) for every item of the dict `items`, running at most `workers` calls at once.
+    Returns a dict of name -> (result, exception), in the order of `items`.
+    """
+    results = {name: (result, exc) for name, result, exc in iter_parallel(func, items, workers)}
+    return {name: results[name] for name in items}
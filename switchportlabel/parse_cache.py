@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+import time
+
+# Entries not used for this long are removed by evict().
+CACHE_MAX_AGE = 7 * 24 * 3600
+
+
+def cache_key(parser_version, parse_func, device_name, text):
+    h = hashlib.sha256()
+    h.update(("%s\0%s\0%s\0" % (parser_version, parse_func.__name__, device_name)).encode())
+    h.update(text.encode())
+    return h.hexdigest()
+
+
+def cached_parse(cachedir, parser_version, parse_func, device_name, text):
+    """
+    Return parse_func(device_name, text), reusing a previous result stored in `cachedir`.
+    Results are keyed by a hash of the raw text, the parser function and `parser_version`.
+    """
+    if cachedir is None:
+        return parse_func(device_name, text)
+
+    fn = os.path.join(cachedir, cache_key(parser_version, parse_func, device_name, text) + ".json")
+    try:
+        with open(fn, "rt") as fp:
+            data = json.load(fp)
+        os.utime(fn)
+        return data
+    except (OSError, ValueError):
+        pass
+
+    data = parse_func(device_name, text)
+    os.makedirs(cachedir, exist_ok=True)
+    tmpfn = "%s.%d.tmp" % (fn, os.getpid())
+    with open(tmpfn, "wt") as fp:
+        json.dump(data, fp)
+    os.replace(tmpfn, fn)
+    return data
+
+
+def evict(cachedir, max_age=CACHE_MAX_AGE):
+    if cachedir is None or not os.path.isdir(cachedir):
+        return
+    cutoff = time.time() - max_age
+    for entry in os.scandir(cachedir):
+        if entry.stat().st_mtime < cutoff:
+            os.unlink(entry.path)
@@ -0,0 +1,176 @@
+"""
+Shared engine for the vendor CLI parsers in acquire_switches.
+
+A parser is described by a rule table, compiled once with compile_rules(). parse_blocks() then walks
+the output a single time: every line is split into indentation and stripped text once, block headers
+start a new record, and body lines are dispatched through the compiled rules:
+
+* PREFIX rules match on the start of the line, all prefixes are combined into one regular expression;
+  the handler gets the rest of the line.
+* KEY rules match "key: value" lines by exact key, via a dict lookup; the handler gets the value.
+* CONTAINS rules match a lowercase substring anywhere in the line; the handler gets the whole line.
+
+Handlers are called as handler(record, text) and update the record in place.
+CONTAINS rules are checked first, then PREFIX rules, then KEY rules; the first match wins.
+
+Blocks that end at an empty line (Comware) are not walked line by line: most of their lines match no rule, so
+the body is searched for the lines a rule may match (one regular expression of all line starts, plus the
+CONTAINS substrings) and only those lines are dispatched.
+"""
+
+import re
+from bisect import bisect_left, bisect_right
+
+PREFIX = "prefix"
+KEY = "key"
+CONTAINS = "contains"
+
+# Line breaks of str.splitlines() besides "\n"; text containing them is always walked line by line
+OTHER_LINE_BREAKS = "\r\v\f\x1c\x1d\x1e\x85\u2028\u2029"
+
+
+def compile_rules(rules, strip_keys=False, strip_values=False):
+    """
+    Compile a list of (kind, pattern, handler) rules into a matcher function(line) -> (handler, text),
+    or (None, None) if no rule matches.
+
+    match.candidates are regular expressions that find, in lowercased text, the lines some rule may match (a
+    superset, the matcher still decides): "\\n" and the start of a PREFIX or KEY line, or a CONTAINS substring.
+    """
+    prefixes = [(pattern, handler) for kind, pattern, handler in rules if kind == PREFIX]
+    keys = {pattern: handler for kind, pattern, handler in rules if kind == KEY}
+    contains = [(pattern, handler) for kind, pattern, handler in rules if kind == CONTAINS]
+
+    prefix_regex = None
+    if prefixes:
+        prefix_regex = re.compile("|".join("(%s)" % re.escape(pattern) for pattern, _ in prefixes))
+    prefix_handlers = [handler for _, handler in prefixes]
+
+    candidates = []
+    starts = [pattern.lower() for kind, pattern, _ in rules if kind != CONTAINS]
+    if starts:
+        candidates.append(re.compile(r"\n[^\S\n]*(?:%s)" % "|".join(re.escape(pattern) for pattern in starts)))
+    if contains:
+        candidates.append(re.compile("|".join(re.escape(pattern) for pattern, _ in contains)))
+
+    def match(line):
+        if contains:
+            lower = line.lower()
+            for pattern, handler in contains:
+                if pattern in lower:
+                    return handler, line
+        if prefix_regex is not None:
+            m = prefix_regex.match(line)
+            if m is not None:
+                return prefix_handlers[m.lastindex - 1], line[m.end() :]
+        if keys:
+            key, sep, value = line.partition(": ")
+            if strip_keys:
+                key = key.strip()
+            handler = keys.get(key)
+            if handler is not None and sep:
+                return handler, value.strip() if strip_values else value
+        return None, None
+
+    match.candidates = candidates
+    return match
+
+
+def parse_blocks(text, header, match, body_indent, blank_line_ends_block, headers_inside_block):
+    """
+    Split `text` into records.
+
+    header(indent, line) returns a new record for a block header line, or None.
+    With headers_inside_block, a header line ends the current record; otherwise headers are only looked
+    for outside of a record, and a record only ends at an empty line (blank_line_ends_block) or at the end.
+    body_indent(indent) tells whether a line at this indentation may hold a field of the current record.
+    """
+    if blank_line_ends_block and not headers_inside_block and hasattr(match, "candidates"):
+        lower = text.lower()
+        # positions in the lowercased text must be the same as in the text ("\u0130" lowercases to two characters)
+        if len(lower) == len(text) and not any(line_break in text for line_break in OTHER_LINE_BREAKS):
+            return parse_paragraphs(text, lower, header, match, body_indent)
+
+    records = []
+    record = None
+    for raw_line in text.splitlines():
+        if not raw_line:
+            if blank_line_ends_block and record is not None:
+                records.append(record)
+                record = None
+            continue
+
+        line = raw_line.lstrip(" ")
+        indent = len(raw_line) - len(line)
+        line = line.strip()
+
+        if record is None or headers_inside_block:
+            new_record = header(indent, line)
+            if new_record is not None:
+                if record is not None:
+                    records.append(record)
+                record = new_record
+                continue
+            if record is None:
+                continue
+
+        if body_indent(indent):
+            handler, value = match(line)
+            if handler is not None:
+                handler(record, value)
+
+    if record is not None:
+        records.append(record)
+    return records
+
+
+def parse_paragraphs(text, lower, header, match, body_indent):
+    """
+    parse_blocks() for blocks that end at an empty line, with headers only outside of a record: the body of a
+    record runs up to the next empty line, and only its lines found by match.candidates in `lower` are dispatched.
+    """
+    line_starts = set()
+    for candidates in match.candidates:
+        for m in candidates.finditer(lower):
+            line_starts.add(lower.rfind("\n", 0, m.start() + 1) + 1)
+    line_starts = sorted(line_starts)
+    next_candidate = 0
+
+    records = []
+    pos = 0
+    end = len(text)
+    while pos < end:
+        line_end = text.find("\n", pos)
+        if line_end == -1:
+            line_end = end
+        raw_line = text[pos:line_end]
+        pos = line_end + 1
+        if not raw_line:
+            continue
+
+        line = raw_line.lstrip(" ")
+        record = header(len(raw_line) - len(line), line.strip())
+        if record is None:
+            continue
+
+        # the body ends before the next empty line; it is empty if the header line is the last one of its block
+        body_end = text.find("\n\n", line_end)
+        if body_end == -1:
+            body_end = end
+        next_candidate = bisect_right(line_starts, line_end, next_candidate)
+        for line_start in line_starts[next_candidate : bisect_left(line_starts, body_end, next_candidate)]:
+            line_end = text.find("\n", line_start, body_end)
+            raw_line = text[line_start : body_end if line_end == -1 else line_end]
+            line = raw_line.lstrip(" ")
+            if body_indent(len(raw_line) - len(line)):
+                handler, value = match(line.strip())
+                if handler is not None:
+                    handler(record, value)
+        records.append(record)
+        pos = body_end + 1
+    return records
+
+
+def parse_rows(text, is_row, make_row, skip_lines=0):
+    """Parse a table: make_row(columns) for every line (after the first `skip_lines`) accepted by is_row(line)."""
+    return [make_row(line.split()) for line in text.splitlines()[skip_lines:] if is_row(line)]
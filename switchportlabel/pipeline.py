@@ -0,0 +1,190 @@
+"""
+Pipelined acquire and configure (`acquire-configure`, `acquire-configure-apply`). Every switch is parsed as soon
+as its snapshot is written, while the other switches are still being acquired, and its contribution to the MAC
+and LLDP indexes is merged right away. A switch is linked and rendered as soon as everything its ports are
+linked from is in: host facts (acquired first), the switches before it (a host MAC is linked to the first
+single-MAC port in switch order) and its LLDP neighbors. Switches are in name order, like in
+acquire_switches.read_switches, so the result is the same as configuring the acquired snapshots.
+
+LLDP seen only from the far end (a switch naming a port of an already rendered switch that does not report it
+as neighbor) can still change a rendered switch; those switches are linked again at the end and rendered again,
+with a warning, if their configuration changed.
+"""
+
+import json
+import os
+
+from . import acquire_switches
+from . import configure
+from . import metrics
+
+
+def host_indexes(hosts):
+    """The host facts, indexed to link one switch at a time: host LLDP by switch, hosts by WWPN and by MAC."""
+    index = {"lldp": {}, "fibrechannel": {}, "ipmi": {}, "networking": {}, "position": {}}
+    for iface in hosts["lldp"]:
+        index["lldp"].setdefault(iface["switchname"], []).append(iface)
+    for hostname, fc_hosts in hosts["fibrechannel"].items():
+        for detail in fc_hosts.values():
+            index["fibrechannel"].setdefault(configure.normalize_wwpn(detail["port_name"]), []).append(hostname)
+    for hostname, ifaces in hosts["ipmi"].items():
+        for host_iface in ifaces:
+            if host_iface.get("mac", None) is not None:
+                index["ipmi"].setdefault(host_iface["mac"], []).append(hostname)
+    for hostname, ifaces in hosts["networking"].items():
+        for host_iface in ifaces.values():
+            index["networking"].setdefault(host_iface["mac"], []).append(hostname)
+    for fact_name in ("fibrechannel", "ipmi", "networking"):
+        index["position"][fact_name] = {hostname: i for i, hostname in enumerate(hosts[fact_name])}
+    return index
+
+
+class Pipeline:
+    """Switches of `order` are passed to finish() once acquired (or failed); `emit` gets their rendered lines."""
+
+    def __init__(self, order, datadir, cachedir, hosts, render, emit):
+        self.order = order
+        self.position = {name: i for i, name in enumerate(order)}
+        self.datadir = datadir
+        self.cachedir = cachedir
+        self.hosts = hosts
+        self.index = host_indexes(hosts)
+        self.render = render
+        self.emit = emit
+        # switches assumed to have data; removed when an acquisition fails and there is no earlier snapshot
+        self.members = set(order)
+        self.switches = {}
+        self.finished = set()
+        # switches of `order` whose single-MAC ports are merged into first_port, a prefix of `order`
+        self.merged = 0
+        self.first_port = {}
+        self.pointing_at = {}
+        self.rendered = {}
+        self.late = set()
+
+    def load(self, name):
+        fn = acquire_switches.snapshot_filename(self.datadir, name)
+        if not os.path.exists(fn):
+            return None
+        with open(fn, "rt") as fp:
+            return acquire_switches.LazySwitch(json.load(fp), self.datadir, self.cachedir)
+
+    def finish(self, name):
+        """Parse the snapshot of `name`, merge it into the indexes, and render all switches that became ready."""
+        switch = self.load(name)
+        self.finished.add(name)
+        if switch is None:
+            self.members.discard(name)
+            self.late.update(s for s in self.rendered if name in self.neighbors(s))
+        else:
+            for datatype in acquire_switches.ACQUIRE_COMMANDS:
+                switch[datatype]
+            self.switches[name] = switch
+            for iface in switch["lldp"]:
+                self.pointing_at.setdefault(iface["hostname"], set()).add(name)
+                if iface["hostname"] in self.rendered and iface["hostname"] != name:
+                    self.late.add(iface["hostname"])
+
+        while self.merged < len(self.order) and self.order[self.merged] in self.finished:
+            self.merge_macs(self.order[self.merged])
+            self.merged += 1
+        for switchname in self.order[: self.merged]:
+            if switchname in self.switches and switchname not in self.rendered:
+                if all(neighbor in self.finished for neighbor in self.neighbors(switchname)):
+                    self.rendered[switchname] = self.link_and_render(switchname, self.switches[switchname])
+                    self.emit(switchname, self.rendered[switchname])
+
+    def neighbors(self, switchname):
+        return {iface["hostname"] for iface in self.switches[switchname]["lldp"] if iface["hostname"] in self.position}
+
+    def merge_macs(self, switchname):
+        """Add the single-MAC ports of the switch to first_port, like configure.index_mactable in switch order."""
+        if switchname not in self.switches:
+            return
+        mactable = self.switches[switchname]["mactable"]
+        port_counts = {}
+        for mac_entry in mactable:
+            port = (mac_entry["switchname"], mac_entry["switchport"])
+            port_counts[port] = port_counts.get(port, 0) + 1
+        for mac_entry in mactable:
+            address = mac_entry["address"]
+            if port_counts[(mac_entry["switchname"], mac_entry["switchport"])] == 1 and address not in self.first_port:
+                if address in self.index["ipmi"] or address in self.index["networking"]:
+                    self.first_port[address] = mac_entry
+
+    def host_subset(self, fact_name, hostnames):
+        position = self.index["position"][fact_name]
+        return {hostname: self.hosts[fact_name][hostname] for hostname in sorted(hostnames, key=position.get)}
+
+    def link_and_render(self, switchname, switch):
+        """Link the ports of one switch like configure.configure, from the indexes, and render it."""
+        scoped = {switchname: switch}
+        configure.link_hosts_lldp(scoped, self.index["lldp"].get(switchname, []))
+
+        wwpns = {configure.normalize_wwpn(row["port_name"]) for row in switch["flogi"]}
+        fc_hosts = {hostname for wwpn in wwpns for hostname in self.index["fibrechannel"].get(wwpn, [])}
+        configure.link_hosts_fc(scoped, self.host_subset("fibrechannel", fc_hosts))
+
+        mac_index = {"by_address": {}, "port_counts": {}}
+        mac_hosts = {"ipmi": set(), "networking": set()}
+        for mac_entry in switch["mactable"]:
+            address = mac_entry["address"]
+            # compared by value, as close() links a freshly parsed copy of the switch
+            if self.first_port.get(address) == mac_entry:
+                mac_index["by_address"][address] = [mac_entry]
+                mac_index["port_counts"][(mac_entry["switchname"], mac_entry["switchport"])] = 1
+                for fact_name, hostnames in mac_hosts.items():
+                    hostnames.update(self.index[fact_name].get(address, []))
+        configure.link_hosts_ipmi(scoped, self.host_subset("ipmi", mac_hosts["ipmi"]), mac_index)
+        configure.link_hosts_networking(scoped, self.host_subset("networking", mac_hosts["networking"]), mac_index)
+
+        # configure.link_switches_lldp, for the LLDP rows of all switches naming this switch
+        sources = ({switchname} | self.pointing_at.get(switchname, set())) & set(self.switches)
+        for source in sorted(sources, key=self.position.get):
+            for iface in self.switches[source]["lldp"]:
+                if iface["hostname"] not in self.members:
+                    continue
+                if source == switchname:
+                    configure.set_port_attr(
+                        scoped, switchname, iface["switchport"], "remote_switchname", iface["hostname"]
+                    )
+                    configure.set_port_attr(
+                        scoped, switchname, iface["switchport"], "remote_switchport", iface["hostport"]
+                    )
+                if iface["hostname"] == switchname:
+                    configure.set_port_attr(scoped, switchname, iface["hostport"], "remote_switchname", source)
+                    configure.set_port_attr(
+                        scoped, switchname, iface["hostport"], "remote_switchport", iface["switchport"]
+                    )
+
+        configure.set_new_descriptions(scoped)
+        configure.count_linked_ports(scoped)
+        return self.render(switchname, switch)
+
+    def close(self):
+        """Link the switches with late LLDP data again, from a fresh parse, and emit them again if they changed."""
+        for switchname in sorted(self.late & set(self.switches), key=self.position.get):
+            lines = self.link_and_render(switchname, self.load(switchname))
+            if lines != self.rendered[switchname]:
+                print("W: LLDP data acquired later changed the configuration of", switchname)
+                self.rendered[switchname] = lines
+                self.emit(switchname, lines)
+
+
+def run(order, acquired, datadir, cachedir, hosts, render, emit):
+    """
+    Feed the switches of `order` into a Pipeline as they come out of `acquired`, an iterator of switch names
+    whose acquisition is over (e.g. from parallel.iter_parallel); switches not in it are used as they are on
+    disk. Returns the rendered lines of all switches with data, in `order`.
+    """
+    pipeline = Pipeline(order, datadir, cachedir, hosts, render, emit)
+    pending = set(order)
+    with metrics.timed("pipeline"):
+        for name in acquired:
+            pending.discard(name)
+            pipeline.finish(name)
+        for name in order:
+            if name in pending:
+                pipeline.finish(name)
+        pipeline.close()
+    return {name: pipeline.rendered[name] for name in order if name in pipeline.rendered}
@@ -0,0 +1,123 @@
+"""
+cProfile support for the CLI actions. Either the whole action ("all") or a single phase is profiled:
+
+* parse: running the parse_* functions in read_switches
+* link: the link_* passes of configure
+* format: computing descriptions and formatting the configuration lines
+
+For every profiled phase, write() stores the raw pstats data, a text report sorted by cumulative time,
+and a collapsed-stack file that flamegraph tools (flamegraph.pl, speedscope, ...) can read.
+"""
+
+from contextlib import contextmanager
+import cProfile
+import io
+import os
+import pstats
+
+PHASES = ["all", "parse", "link", "format"]
+
+# Call paths contributing less than this many seconds are left out of the collapsed stacks.
+COLLAPSED_MIN_SECONDS = 1e-6
+
+_scope = None
+_profiles = {}
+_active = []
+
+
+def enable(scope):
+    global _scope
+    _scope = scope
+
+
+@contextmanager
+def phase(name):
+    """
+    Profile the with-block if `name` is the phase selected with enable(). Time accumulates per phase. Another
+    phase nested in the profiled one (e.g. a switch parsed lazily while linking) is not counted in it.
+    """
+    if _active and _active[-1] == _scope != "all" and name != _scope:
+        profile = _profiles[_scope]
+        profile.disable()
+        _active.append(name)
+        try:
+            yield
+        finally:
+            _active.pop()
+            profile.enable()
+        return
+    if _scope != name or _active:
+        yield
+        return
+
+    profile = _profiles.setdefault(name, cProfile.Profile())
+    _active.append(name)
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _active.pop()
+
+
+def label(func):
+    filename, line, funcname = func
+    if filename == "~":
+        text = funcname
+    else:
+        text = "%s:%d(%s)" % (os.path.basename(filename), line, funcname)
+    return text.replace(";", ":").replace(" ", "_")
+
+
+def collapsed_stacks(stats):
+    """
+    Turn the caller/callee graph of pstats.Stats into collapsed stacks ("a;b;c seconds").
+    cProfile only records single call edges, so time on deeper paths is split in proportion to
+    the cumulative time of each edge.
+    """
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, {})[func] = edge
+
+    stacks = {}
+
+    def walk(func, path, own_time, cumulative_time):
+        path = path + (func,)
+        key = ";".join(label(f) for f in path)
+        stacks[key] = stacks.get(key, 0) + own_time
+        total_cumulative_time = stats.stats[func][3]
+        if total_cumulative_time <= 0:
+            return
+        scale = cumulative_time / total_cumulative_time
+        for callee, (_, _, callee_own_time, callee_cumulative_time) in callees.get(func, {}).items():
+            if callee in path or callee_cumulative_time * scale < COLLAPSED_MIN_SECONDS:
+                continue
+            walk(callee, path, callee_own_time * scale, callee_cumulative_time * scale)
+
+    for func, (_, _, own_time, cumulative_time, callers) in stats.stats.items():
+        if not callers:
+            walk(func, (), own_time, cumulative_time)
+
+    return stacks
+
+
+def write(directory):
+    os.makedirs(directory, exist_ok=True)
+    for name, profile in _profiles.items():
+        base = os.path.join(directory, name)
+        profile.dump_stats(base + ".pstats")
+
+        report = io.StringIO()
+        stats = pstats.Stats(profile, stream=report)
+        stats.sort_stats("cumulative").print_stats(50)
+        with open(base + ".txt", "wt") as fp:
+            fp.write(report.getvalue())
+
+        with open(base + ".collapsed", "wt") as fp:
+            for stack, seconds in sorted(collapsed_stacks(stats).items()):
+                # flamegraph tools expect integer sample counts, use microseconds
+                if int(seconds * 1e6) > 0:
+                    fp.write("%s %d\n" % (stack, int(seconds * 1e6)))
+
+        print("I: profile of phase", name, "written to", base + ".{pstats,txt,collapsed}")
@@ -0,0 +1,37 @@
+"""
+Selectors for scoped runs (--switch, --host). A selector is a device or host name, a glob ("sw-r12-*"), or
+OPTION=VALUE (VALUE may be a glob) matching a setting of the device's section in data/switches.ini,
+e.g. "device_type=hp_procurve" or a site-specific "rack=r12". Hosts also match by their short name.
+"""
+
+from fnmatch import fnmatchcase
+
+
+def matches(name, selector, device_options=None):
+    if "=" in selector:
+        option, _, pattern = selector.partition("=")
+        return device_options is not None and fnmatchcase(device_options.get(option, ""), pattern)
+    return fnmatchcase(name, selector)
+
+
+def select_switches(names, selectors, device_options):
+    """The switches of `names` (in their order) matched by any selector, warning about selectors matching none."""
+    for selector in selectors:
+        if not any(matches(name, selector, device_options.get(name)) for name in names):
+            print("W: switch selector", selector, "matches no switch")
+    return [name for name in names if any(matches(name, selector, device_options.get(name)) for selector in selectors)]
+
+
+def host_matches(hostname, selectors):
+    return any(matches(hostname, selector) or matches(hostname.split(".")[0], selector) for selector in selectors)
+
+
+def select_hosts(hosts, selectors):
+    """The names of the hosts in the facts returned by acquire_puppetdb.read_facts matched by any selector."""
+    hostnames = set()
+    for fact in hosts.values():
+        if isinstance(fact, dict):
+            hostnames.update(fact)
+        else:
+            hostnames.update(row["hostname"] for row in fact)
+    return {hostname for hostname in hostnames if host_matches(hostname, selectors)}
@@ -0,0 +1,219 @@
+"""
+SQLite snapshot database (`--db FILE`). `acquire` can store the parsed switch data and the PuppetDB host facts
+in one indexed database, which `configure` then reads instead of the snapshot directories: switch datatypes are
+loaded per switch when first used, and hosts are matched to mactable and FLOGI entries with indexed joins.
+Other tools can query the same database without parsing anything.
+
+Every row keeps its full parsed data as JSON in `data`, next to the indexed columns.
+"""
+
+from urllib.request import pathname2url
+import json
+import os
+import sqlite3
+
+from . import acquire_switches
+from . import metrics
+from .configure import normalize_wwpn
+
+SCHEMA = """
+CREATE TABLE switches (name TEXT PRIMARY KEY, device_type TEXT, transport TEXT, acquired_at REAL, data TEXT);
+CREATE TABLE interfaces (switchname TEXT, switchport TEXT, description TEXT, data TEXT);
+CREATE TABLE lldp (switchname TEXT, switchport TEXT, hostname TEXT, hostport TEXT, data TEXT);
+CREATE TABLE flogi (switchname TEXT, switchport TEXT, wwpn TEXT, data TEXT);
+CREATE TABLE mactable (switchname TEXT, switchport TEXT, vlan TEXT, address TEXT, data TEXT);
+CREATE TABLE host_fc (hostname TEXT, host_id TEXT, wwpn TEXT, data TEXT);
+CREATE TABLE host_ipmi (hostname TEXT, mac TEXT, data TEXT);
+CREATE TABLE host_networking (hostname TEXT, hostport TEXT, mac TEXT, data TEXT);
+CREATE TABLE host_lldp (hostname TEXT, hostport TEXT, switchname TEXT, switchport TEXT, data TEXT);
+"""
+
+# Created after the tables are filled, which is faster than maintaining them on every insert
+INDEXES = """
+CREATE INDEX interfaces_port ON interfaces (switchname, switchport);
+CREATE INDEX lldp_port ON lldp (switchname, switchport);
+CREATE INDEX lldp_hostname ON lldp (hostname);
+CREATE INDEX flogi_wwpn ON flogi (wwpn);
+CREATE INDEX flogi_port ON flogi (switchname, switchport);
+CREATE INDEX mactable_address ON mactable (address);
+CREATE INDEX mactable_port ON mactable (switchname, switchport);
+CREATE INDEX host_fc_wwpn ON host_fc (wwpn);
+CREATE INDEX host_ipmi_mac ON host_ipmi (mac);
+CREATE INDEX host_networking_mac ON host_networking (mac);
+CREATE INDEX host_lldp_port ON host_lldp (switchname, switchport);
+"""
+
+# datatype -> (table, function returning the indexed columns of a parsed row)
+SWITCH_TABLES = {
+    "interfaces": ("interfaces", lambda row: (row["switchport"], row.get("description"))),
+    "lldp": ("lldp", lambda row: (row["switchport"], row["hostname"], row["hostport"])),
+    "flogi": ("flogi", lambda row: (row["switchport"], normalize_wwpn(row["port_name"]))),
+    "mactable": ("mactable", lambda row: (row["switchport"], row["vlan"], row["address"])),
+}
+
+
+def insert(conn, table, rows):
+    """Insert `rows` (tuples ending with the data to be stored as JSON) into `table`."""
+    rows = [row[:-1] + (json.dumps(row[-1]),) for row in rows]
+    if rows:
+        conn.executemany("INSERT INTO %s VALUES (%s)" % (table, ", ".join("?" * len(rows[0]))), rows)
+
+
+@metrics.timed("write_db")
+def write_db(fn, switches, hosts):
+    """Write the switches (as returned by acquire_switches.read_switches) and host facts into a new database `fn`."""
+    tmpfn = fn + ".tmp"
+    if os.path.exists(tmpfn):
+        os.unlink(tmpfn)
+    conn = sqlite3.connect(tmpfn)
+    try:
+        with conn:
+            conn.executescript(SCHEMA)
+            for switchname, switch in switches.items():
+                info = {key: value for key, value in switch.items() if not key.startswith("raw_")}
+                for datatype in list(SWITCH_TABLES) + ["interface_aliases"]:
+                    info.pop(datatype, None)
+                insert(
+                    conn,
+                    "switches",
+                    [
+                        (
+                            switchname,
+                            switch["device_type"],
+                            switch.get("transport", "ssh"),
+                            switch.get("acquired_at"),
+                            info,
+                        )
+                    ],
+                )
+                for datatype, (table, columns) in SWITCH_TABLES.items():
+                    data = switch[datatype]
+                    rows = data.values() if isinstance(data, dict) else data
+                    insert(conn, table, [(switchname,) + columns(row) + (row,) for row in rows])
+
+            insert(
+                conn,
+                "host_fc",
+                [
+                    (hostname, host_id, normalize_wwpn(detail["port_name"]), detail)
+                    for hostname, fc_hosts in hosts["fibrechannel"].items()
+                    for host_id, detail in fc_hosts.items()
+                ],
+            )
+            insert(
+                conn,
+                "host_ipmi",
+                [
+                    (hostname, host_iface.get("mac", None), host_iface)
+                    for hostname, ifaces in hosts["ipmi"].items()
+                    for host_iface in ifaces
+                ],
+            )
+            insert(
+                conn,
+                "host_networking",
+                [
+                    (hostname, hostport, host_iface["mac"], host_iface)
+                    for hostname, ifaces in hosts["networking"].items()
+                    for hostport, host_iface in ifaces.items()
+                ],
+            )
+            insert(
+                conn,
+                "host_lldp",
+                [
+                    (iface["hostname"], iface["hostport"], iface["switchname"], iface["switchport"], iface)
+                    for iface in hosts["lldp"]
+                ],
+            )
+            conn.executescript(INDEXES)
+    finally:
+        conn.close()
+    os.replace(tmpfn, fn)
+
+
+def connect(fn):
+    """Open the database `fn` read-only; fails if it does not exist."""
+    return sqlite3.connect("file:%s?mode=ro" % pathname2url(os.path.abspath(fn)), uri=True)
+
+
+class DbSwitch(dict):
+    """Device info of a switch in the database; datatypes are loaded when first accessed, like LazySwitch."""
+
+    def __init__(self, info, conn):
+        super().__init__(info)
+        self.conn = conn
+
+    def __missing__(self, key):
+        if key == "interface_aliases":
+            value = acquire_switches.map_interface_aliases(self["interfaces"])
+        elif key in SWITCH_TABLES:
+            rows = [
+                json.loads(data)
+                for (data,) in self.conn.execute(
+                    "SELECT data FROM %s WHERE switchname = ? ORDER BY rowid" % SWITCH_TABLES[key][0],
+                    (self["device_name"],),
+                )
+            ]
+            value = {row["switchport"]: row for row in rows} if key == "interfaces" else rows
+            if key == "interfaces":
+                metrics.add("interfaces", len(value), device=self["device_name"])
+        else:
+            raise KeyError(key)
+        self[key] = value
+        return value
+
+
+@metrics.timed("read_switches")
+def read_switches(conn):
+    return {
+        name: DbSwitch(json.loads(data), conn)
+        for name, data in conn.execute("SELECT name, data FROM switches ORDER BY rowid")
+    }
+
+
+@metrics.timed("read_facts")
+def read_facts(conn):
+    """The host facts, as returned by acquire_puppetdb.read_facts."""
+    hosts = {"fibrechannel": {}, "ipmi": {}, "lldp": [], "networking": {}}
+    for hostname, host_id, data in conn.execute("SELECT hostname, host_id, data FROM host_fc ORDER BY rowid"):
+        hosts["fibrechannel"].setdefault(hostname, {})[host_id] = json.loads(data)
+    for hostname, data in conn.execute("SELECT hostname, data FROM host_ipmi ORDER BY rowid"):
+        hosts["ipmi"].setdefault(hostname, []).append(json.loads(data))
+    for (data,) in conn.execute("SELECT data FROM host_lldp ORDER BY rowid"):
+        hosts["lldp"].append(json.loads(data))
+    for hostname, hostport, data in conn.execute("SELECT hostname, hostport, data FROM host_networking ORDER BY rowid"):
+        hosts["networking"].setdefault(hostname, {})[hostport] = json.loads(data)
+    return hosts
+
+
+def index_flogi(conn, switches):
+    """configure.index_flogi for the host WWPNs only, from an indexed join; limited to `switches`."""
+    by_wwpn = {}
+    for wwpn, switchname, data in conn.execute(
+        "SELECT wwpn, switchname, data FROM flogi WHERE wwpn IN (SELECT wwpn FROM host_fc) ORDER BY rowid"
+    ):
+        if switchname in switches:
+            by_wwpn.setdefault(wwpn, []).append((switchname, json.loads(data)))
+    return by_wwpn
+
+
+def index_mactable(conn, switches):
+    """
+    Resolve the host MACs against the mactables with an indexed join, keeping for every MAC the first entry
+    (in switch and mactable order) on a port with exactly one MAC. Limited to `switches`, and returned in the
+    shape of configure.index_mactable, so find_unique_mac can be used unchanged.
+    """
+    by_address = {}
+    port_counts = {}
+    rows = conn.execute("""
+        SELECT address, switchname, switchport FROM mactable AS m
+        WHERE address IN (SELECT mac FROM host_ipmi UNION SELECT mac FROM host_networking)
+        AND (SELECT count(*) FROM mactable AS c WHERE c.switchname = m.switchname AND c.switchport = m.switchport) = 1
+        ORDER BY rowid
+        """)
+    for address, switchname, switchport in rows:
+        if switchname in switches and address not in by_address:
+            by_address[address] = [{"address": address, "switchname": switchname, "switchport": switchport}]
+            port_counts[(switchname, switchport)] = 1
+    return {"by_address": by_address, "port_counts": port_counts}
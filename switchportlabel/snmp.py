@@ -0,0 +1,132 @@
+"""
+SNMP transport, for switches that are slow or fragile over SSH: GETBULK walks of IF-MIB, Q-BRIDGE-MIB/BRIDGE-MIB and
+LLDP-MIB using `snmpbulkwalk` from net-snmp. Enable with `transport=snmp` in data/switches.ini; SNMPv2c only.
+
+All tables of a switch are walked at the same time; devices are walked concurrently with --workers.
+Walks run with -On -Oq -Ox -Oe: numeric OIDs, no type names, octet strings as hex and enums as numbers.
+"""
+
+import socket
+import subprocess
+
+from . import metrics
+
+IF_NAME = ".1.3.6.1.2.1.31.1.1.1.1"
+IF_ALIAS = ".1.3.6.1.2.1.31.1.1.1.18"
+IF_OPER_STATUS = ".1.3.6.1.2.1.2.2.1.8"
+DOT1D_BASE_PORT_IF_INDEX = ".1.3.6.1.2.1.17.1.4.1.2"
+DOT1D_TP_FDB_PORT = ".1.3.6.1.2.1.17.4.3.1.2"
+DOT1Q_TP_FDB_PORT = ".1.3.6.1.2.1.17.7.1.2.2.1.2"
+LLDP_LOC_PORT_ID_SUBTYPE = ".1.0.8802.1.1.2.1.3.7.1.2"
+LLDP_LOC_PORT_ID = ".1.0.8802.1.1.2.1.3.7.1.3"
+LLDP_REM_PORT_ID_SUBTYPE = ".1.0.8802.1.1.2.1.4.1.1.6"
+LLDP_REM_PORT_ID = ".1.0.8802.1.1.2.1.4.1.1.7"
+LLDP_REM_SYS_NAME = ".1.0.8802.1.1.2.1.4.1.1.9"
+
+SNMP_WALKS = {
+    "interfaces": [IF_NAME, IF_ALIAS, IF_OPER_STATUS],
+    "lldp": [
+        IF_NAME,
+        LLDP_LOC_PORT_ID_SUBTYPE,
+        LLDP_LOC_PORT_ID,
+        LLDP_REM_PORT_ID_SUBTYPE,
+        LLDP_REM_PORT_ID,
+        LLDP_REM_SYS_NAME,
+    ],
+    "mactable": [IF_NAME, DOT1D_BASE_PORT_IF_INDEX, DOT1Q_TP_FDB_PORT, DOT1D_TP_FDB_PORT],
+}
+
+# Values that snmpbulkwalk prints instead of a table
+NO_DATA = ("No Such Object", "No Such Instance", "No more variables")
+
+
+def walk_command(device_options, oid):
+    agent = "udp:%s:%s" % (device_options["ip"], device_options.get("snmp_port", "161"))
+    return [
+        "snmpbulkwalk",
+        "-v2c",
+        "-c",
+        device_options.get("snmp_community", "public"),
+        "-t",
+        device_options.get("snmp_timeout", "5"),
+        "-r",
+        device_options.get("snmp_retries", "2"),
+        "-Cr%s" % device_options.get("snmp_max_repetitions", "50"),
+        "-On",
+        "-Oq",
+        "-Ox",
+        "-Oe",
+        agent,
+        oid,
+    ]
+
+
+def acquire(device_name, device_options):
+    """Walk all tables, returned as raw_<datatype> texts holding the walks of SNMP_WALKS[datatype]."""
+    oids = sorted({oid for walk in SNMP_WALKS.values() for oid in walk})
+    print("Walking SNMP of", device_name)
+    with metrics.timed("acquire_snmp_walk", device=device_name):
+        processes = {
+            oid: subprocess.Popen(
+                walk_command(device_options, oid),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+            )
+            for oid in oids
+        }
+        outputs = {}
+        for oid, process in processes.items():
+            stdout, stderr = process.communicate()
+            if process.returncode != 0:
+                for other in processes.values():
+                    other.kill()
+                    other.wait()
+                message = "snmpbulkwalk %s failed: %s" % (oid, stderr.strip())
+                if stderr.startswith("Timeout"):
+                    raise socket.timeout(message)
+                raise RuntimeError(message)
+            outputs[oid] = stdout
+
+    raw = {}
+    for datatype, walk in SNMP_WALKS.items():
+        raw["raw_%s" % datatype] = "".join(outputs[oid] for oid in walk)
+        metrics.add("acquire_received_bytes", len(raw["raw_%s" % datatype]), device=device_name, datatype=datatype)
+    return raw
+
+
+def parse_walk(text, columns):
+    """
+    Split snmpbulkwalk output into {column: {index: value}} for the given column OIDs.
+    Long hex strings are wrapped by snmpbulkwalk, continuation lines are joined.
+    """
+    tables = {column: {} for column in columns}
+    column_prefixes = [(column + ".", tables[column]) for column in columns]
+    last = None
+    for line in text.splitlines():
+        if not line.startswith("."):
+            if last is not None and line.strip():
+                table, index = last
+                table[index] += " " + line.strip()
+            continue
+        last = None
+        oid, _, value = line.partition(" ")
+        value = value.strip()
+        if value.startswith(NO_DATA):
+            continue
+        for prefix, table in column_prefixes:
+            if oid.startswith(prefix):
+                index = oid[len(prefix) :]
+                table[index] = value
+                last = (table, index)
+                break
+    return tables
+
+
+def decode_octets(value):
+    """Octet string printed by -Ox ("47 69 31 2F 30"), as bytes."""
+    return bytes.fromhex(value.strip('"').replace(" ", ""))
+
+
+def decode_string(value):
+    return decode_octets(value).decode("utf-8", "replace")
@@ -0,0 +1,367 @@
+"""
+Generate a synthetic fleet: raw switch outputs as acquire_switches.acquire() stores them, and matching
+PuppetDB fact dumps as acquire_puppetdb.acquire() stores them. Used by the benchmarks.
+
+Even numbered switches are Cisco NX-OS (with Fibre Channel ports), odd numbered ones HP Comware7.
+The last two Ethernet ports of every switch are uplinks to the next switch, announced via LLDP;
+the uplink also learns all MACs of the switch's host ports. Host ports cycle through: a server seen
+in the `networking` fact, an IPMI interface, a server seen via host LLDP, and a hypervisor port
+carrying `macs_per_port` MACs.
+"""
+
+import json
+import os
+import random
+
+from . import acquire_puppetdb
+from . import acquire_switches
+
+NXOS_INTERFACE = """\
+Ethernet{slot}/{port} is {state}
+admin state is up, Dedicated Interface
+  Hardware: 1000/10000 Ethernet, address: {mac_dotted} (bia {mac_dotted})
+  Description: {description}
+  MTU 1500 bytes, BW 10000000 Kbit, DLY 10 usec
+  reliability 255/255, txload 1/255, rxload 1/255
+  Encapsulation ARPA, medium is broadcast
+  Port mode is trunk
+  full-duplex, 10 Gb/s, media type is 10G
+  Beacon is turned off
+  Input flow-control is off, output flow-control is off
+  Rate mode is dedicated
+  Switchport monitor is off
+  EtherType is 0x8100
+  Last link flapped 22week(s) 4day(s)
+  Last clearing of "show interface" counters never
+  7 interface resets
+  30 seconds input rate 227112 bits/sec, 110 packets/sec
+  30 seconds output rate 4921616 bits/sec, 996 packets/sec
+  Load-Interval #2: 5 minute (300 seconds)
+    input rate 10.04 Mbps, 897 pps; output rate 4.86 Mbps, 961 pps
+  RX
+    41682888016 unicast packets  1750939 multicast packets  38498 broadcast packets
+    41684677453 input packets  131894499558140 bytes
+    15085420582 jumbo packets  0 storm suppression bytes
+    0 runts  0 giants  0 CRC  0 no buffer
+    0 input error  0 short frame  0 overrun   0 underrun  0 ignored
+    0 watchdog  0 bad etype drop  0 bad proto drop  0 if down drop
+    0 input with dribble  0 input discard
+    0 Rx pause
+  TX
+    42910039734 unicast packets  24940038 multicast packets  16458216 broadcast packets
+    42951437988 output packets  74856481807857 bytes
+    12220089271 jumbo packets
+    0 output error  0 collision  0 deferred  0 late collision
+    0 lost carrier  0 no carrier  0 babble 0 output discard
+    0 Tx pause
+
+"""
+
+NXOS_FC_INTERFACE = """\
+fc{slot}/{port} is up
+    Port description is {description}
+    Hardware is Fibre Channel, SFP is short wave laser w/o OFC (SN)
+    Port WWN is {wwn}
+    Admin port mode is auto, trunk mode is on
+    snmp link state traps are enabled
+    Port vsan is 1
+    Receive data field Size is 2112
+    Beacon is turned off
+    1 minute input rate 0 bits/sec, 0 bytes/sec, 0 frames/sec
+    1 minute output rate 0 bits/sec, 0 bytes/sec, 0 frames/sec
+    4540562 frames input, 339027424 bytes
+      0 discards, 0 errors
+      0 CRC,  0 unknown class
+      0 too long, 0 too short
+    4540999 frames output, 357166908 bytes
+      0 discards, 0 errors
+    0 input OLS, 0 LRR, 0 NOS, 0 loop inits
+    4 output OLS, 4 LRR, 4 NOS, 0 loop inits
+    last clearing of "show interface" counters never
+    Interface last changed at Thu Aug  9 12:41:31 2018
+
+"""
+
+COMWARE_INTERFACE = """\
+Ten-GigabitEthernet{slot}/0/{port}
+Current state: {state}
+Line protocol state: {state}
+IP packet frame type: Ethernet II, hardware address: {mac_dashed}
+Description: {description}
+Bandwidth: 10000000 kbps
+Loopback is not set
+Media type is optical fiber, port hardware type is 10G_BASE_SR_SFP
+10Gbps-speed mode, full-duplex mode
+Link speed type is autonegotiation, link duplex type is autonegotiation
+Flow-control is not enabled
+Maximum frame length: 10000
+Allow jumbo frames to pass
+Broadcast max-ratio: 100%
+Multicast max-ratio: 100%
+Unicast max-ratio: 100%
+PVID: 191
+MDI type: Automdix
+Port link-type: Access
+ Tagged VLANs:   None
+ Untagged VLANs: 191
+Port priority: 0
+Last link flapping: 2 days 0 hours 6 minutes
+Last clearing of counters: Never
+ Peak input rate: 123227249 bytes/sec, at 2018-10-24 05:29:40
+ Peak output rate: 288172772 bytes/sec, at 2018-06-23 06:44:31
+ Last 300 second input: 112 packets/sec 19834 bytes/sec 0%
+ Last 300 second output: 142 packets/sec 44772 bytes/sec 0%
+ Input (total):  4358237286 packets, 4432560568556 bytes
+          4303929389 unicasts, 62 broadcasts, 33895095 multicasts, 20412740 pauses
+ Input (normal):  4337824546 packets, - bytes
+          4303929389 unicasts, 62 broadcasts, 33895095 multicasts, 20412740 pauses
+ Input:  0 input errors, 0 runts, 0 giants, 0 throttles
+          0 CRC, 0 frame, - overruns, 0 aborts
+          - ignored, - parity errors
+ Output (total): 3755453007 packets, 2061360496941 bytes
+          3243358465 unicasts, 56720 broadcasts, 509956054 multicasts, 2081768 pauses
+ Output (normal): 3753371239 packets, - bytes
+          3243358465 unicasts, 56720 broadcasts, 509956054 multicasts, 2081768 pauses
+ Output: 0 output errors, - underruns, - buffer failures
+          0 aborts, 0 deferred, 0 collisions, 0 late collisions
+          0 lost carrier, - no carrier
+
+"""
+
+COMWARE_LLDP = """\
+LLDP neighbor-information of port {index}[{port}]:
+LLDP agent nearest-bridge:
+ LLDP neighbor index : 1
+ Update time         : 1 days, 23 hours, 7 minutes, 8 seconds
+ Chassis type        : MAC address
+ Chassis ID          : {mac_dashed}
+ Port ID type        : Interface name
+ Port ID             : {remote_port}
+ Time to live        : 120
+ Port description    : {remote_port}
+ System name         : {remote_name}
+ System description  : Synthetic switch
+ System capabilities supported : Bridge, Router
+ System capabilities enabled   : Bridge, Router
+ Management address type           : IPv4
+ Management address                : 192.168.1.1
+ Management address interface type : IfIndex
+ Management address interface ID   : 6
+ Management address OID            : 0
+
+"""
+
+FC_PORTS = 8
+HOST_KINDS = ["networking", "ipmi", "lldp", "hypervisor"]
+
+
+def dotted(mac):
+    return "%s.%s.%s" % (mac[0:4], mac[4:8], mac[8:12])
+
+
+def dashed(mac):
+    return "%s-%s-%s" % (mac[0:4], mac[4:8], mac[8:12])
+
+
+def coloned(mac):
+    return ":".join(mac[i : i + 2] for i in range(0, len(mac), 2))
+
+
+def switch_ports(switch_index, ports):
+    """Full and short port names, as `show int`/`display interface` and the mactable print them."""
+    if switch_index % 2 == 0:
+        return [("Ethernet1/%d" % port, "Eth1/%d" % port) for port in range(1, ports + 1)]
+    return [("Ten-GigabitEthernet1/0/%d" % port, "XGE1/0/%d" % port) for port in range(1, ports + 1)]
+
+
+def generate_switch(switch_index, switch_names, ports, macs_per_port, rnd, facts):
+    """Return the snapshot and number of mactable entries of one switch, and add its hosts to `facts`."""
+    device_name = switch_names[switch_index]
+    nxos = switch_index % 2 == 0
+    port_names = switch_ports(switch_index, ports)
+    next_index = (switch_index + 1) % len(switch_names)
+    prev_index = (switch_index - 1) % len(switch_names)
+
+    interfaces = []
+    lldp = []
+    mactable = []
+    flogi = []
+
+    for port_index, (port_name, short_name) in enumerate(port_names):
+        port = port_index + 1
+        mac = "%012x" % rnd.getrandbits(48)
+        state = rnd.choice(["up", "up", "up", "down"])
+        description = "Cust: old%d-%d eth0" % (switch_index, port)
+        if nxos:
+            interfaces.append(
+                NXOS_INTERFACE.format(slot=1, port=port, state=state, mac_dotted=dotted(mac), description=description)
+            )
+        else:
+            interfaces.append(
+                COMWARE_INTERFACE.format(
+                    slot=1, port=port, state=state.upper(), mac_dashed=dashed(mac), description=description
+                )
+            )
+
+        if port_index >= ports - 2:
+            # uplinks, to the next switch (first uplink) and the previous switch (second uplink)
+            remote_index = next_index if port_index == ports - 2 else prev_index
+            if len(switch_names) == 1:
+                continue
+            remote_port = switch_ports(remote_index, ports)[ports - 1 if port_index == ports - 2 else ports - 2][0]
+            lldp.append((port_name, short_name, switch_names[remote_index], remote_port))
+            continue
+
+        hostname = "host-%s-%d.example.com" % (device_name, port)
+        kind = HOST_KINDS[port_index % len(HOST_KINDS)]
+        host_mac = "%012x" % rnd.getrandbits(48)
+        if kind == "networking":
+            facts["networking"].append(
+                {
+                    "certname": hostname,
+                    "name": "networking",
+                    "value": {
+                        "interfaces": {
+                            "eth0": {"mac": coloned(host_mac), "mtu": 1500},
+                            "lo": {"mtu": 65536},
+                            "docker0": {"mac": coloned("%012x" % rnd.getrandbits(48))},
+                        }
+                    },
+                }
+            )
+            mactable.append((host_mac, "10", short_name))
+        elif kind == "ipmi":
+            facts["ipmi"].append(
+                {
+                    "certname": hostname,
+                    "name": "ipmi",
+                    "value": [{"ip_address": "10.0.0.1", "subnet_mask": "255.255.255.0", "mac": host_mac}],
+                }
+            )
+            mactable.append((host_mac, "20", short_name))
+        elif kind == "lldp":
+            facts["lldp"].append(
+                {
+                    "certname": hostname,
+                    "name": "lldp",
+                    "value": {
+                        "neighbors": {
+                            "eno1": {
+                                "sysname": "%s Synthetic switch" % device_name,
+                                "portid": "ifname %s" % port_name,
+                            }
+                        }
+                    },
+                }
+            )
+            mactable.append((host_mac, "10", short_name))
+        else:
+            for _ in range(macs_per_port):
+                mactable.append(("%012x" % rnd.getrandbits(48), "30", short_name))
+
+    # uplinks learn everything of the host ports
+    if len(switch_names) > 1:
+        uplink = port_names[ports - 2][1]
+        mactable.extend([(mac, vlan, uplink) for mac, vlan, _ in list(mactable)])
+
+    if nxos:
+        for port in range(1, FC_PORTS + 1):
+            wwn = "20:%02x:00:de:fb:ee:%02x:%02x" % (port, switch_index // 256, switch_index % 256)
+            interfaces.append(NXOS_FC_INTERFACE.format(slot=2, port=port, wwn=wwn, description="old fc"))
+            port_name = "10:00:00:90:fa:%02x:%02x:%02x" % (switch_index // 256, switch_index % 256, port)
+            flogi.append(
+                "fc2/%-13d 1     0x0b%04x  %s %s" % (port, port, port_name, port_name.replace("10:", "20:", 1))
+            )
+            facts["fibrechannel"].append(
+                {
+                    "certname": "fc-%s-%d.example.com" % (device_name, port),
+                    "name": "fibrechannel",
+                    "value": {"hosts": {"host1": {"port_name": port_name.replace(":", ""), "port_state": "Online"}}},
+                }
+            )
+
+        raw_lldp = {
+            "TABLE_nbor_detail": {
+                "ROW_nbor_detail": [
+                    {"l_port_id": short_name, "sys_name": remote_name, "port_id": remote_port}
+                    for _, short_name, remote_name, remote_port in lldp
+                ]
+            }
+        }
+        raw_mactable = {
+            "TABLE_mac_address": {
+                "ROW_mac_address": [
+                    {"disp_mac_addr": dotted(mac), "disp_vlan": vlan, "disp_port": port, "disp_type": "dynamic"}
+                    for mac, vlan, port in mactable
+                ]
+            }
+        }
+        total = {
+            "device_type": "cisco_nxos",
+            "device_type_flavor": "",
+            "device_name": device_name,
+            "raw_interfaces": "".join(interfaces),
+            "raw_flogi": "-" * 80
+            + "\nINTERFACE        VSAN    FCID           PORT NAME               NODE NAME\n"
+            + "-" * 80
+            + "\n"
+            + "\n".join(flogi)
+            + "\n\nTotal number of flogi = %d.\n" % len(flogi),
+            "raw_lldp": json.dumps(raw_lldp),
+            "raw_mactable": json.dumps(raw_mactable),
+        }
+        return total, len(mactable)
+
+    raw_lldp = "".join(
+        COMWARE_LLDP.format(
+            index=index,
+            port=port_name,
+            mac_dashed=dashed("%012x" % index),
+            remote_port=remote_port,
+            remote_name=remote_name,
+        )
+        for index, (port_name, _, remote_name, remote_port) in enumerate(lldp)
+    )
+    raw_mactable = "MAC Address      VLAN ID    State            Port/NickName            Aging\n" + "".join(
+        "%-16s %-10s Learned          %-24s Y\n" % (dashed(mac), vlan, port) for mac, vlan, port in mactable
+    )
+    total = {
+        "device_type": "hp_comware",
+        "device_type_flavor": "7",
+        "device_name": device_name,
+        "raw_interfaces": "".join(interfaces),
+        "raw_flogi": "",
+        "raw_lldp": raw_lldp,
+        "raw_mactable": raw_mactable,
+    }
+    return total, len(mactable)
+
+
+def generate_fleet(datadir, switches=10, ports=48, macs_per_port=16, seed=0):
+    """
+    Write `switches` switch snapshots to `datadir`/switches/ and the matching PuppetDB facts
+    to `datadir`/puppetdb/. Returns a dict with the number of generated switches, hosts and mactable entries.
+    """
+    rnd = random.Random(seed)
+    switch_names = ["sw%04d.example.com" % i for i in range(switches)]
+    facts = {fact_name: [] for fact_name in acquire_puppetdb.FACT_NAMES}
+    switches_datadir = os.path.join(datadir, "switches")
+    puppetdb_datadir = os.path.join(datadir, "puppetdb")
+    os.makedirs(switches_datadir, exist_ok=True)
+    os.makedirs(puppetdb_datadir, exist_ok=True)
+
+    mactable_entries = 0
+    for switch_index in range(switches):
+        total, entries = generate_switch(switch_index, switch_names, ports, macs_per_port, rnd, facts)
+        mactable_entries += entries
+        acquire_switches.write_snapshot(switches_datadir, total)
+
+    for fact_name, elements in facts.items():
+        with open(acquire_puppetdb.snapshot_filename(puppetdb_datadir, "puppetdb", fact_name), "wt") as fp:
+            json.dump(elements, fp)
+
+    return {
+        "switches": switches,
+        "hosts": sum(len(elements) for elements in facts.values()),
+        "mactable_entries": mactable_entries,
+    }
@@ -0,0 +1,120 @@
+import json
+
+from switchportlabel import acquire_switches
+from switchportlabel import nxapi
+
+NXAPI_INTERFACES = {
+    "TABLE_interface": {
+        "ROW_interface": [
+            {
+                "interface": "Ethernet1/1",
+                "state": "up",
+                "desc": "old ",
+                "eth_hw_desc": "100/1000/10000 Ethernet",
+                "eth_hw_addr": "00de.fbee.ab01",
+            },
+            {
+                "interface": "Vlan10",
+                "svi_admin_state": "up",
+                "svi_line_proto": "up",
+                "svi_hw_desc": "EtherSVI",
+                "svi_mac": "00de.fbee.ab00",
+                "svi_desc": "servers",
+            },
+            {
+                "interface": "port-channel4",
+                "state": "up",
+                "eth_hw_desc": "Port-Channel",
+                "eth_members": "Eth1/4, Eth1/5",
+            },
+            {"interface": "mgmt0", "state": "up", "eth_hw_addr": "00de.fbee.abff"},
+        ]
+    }
+}
+
+
+def test_parse_cisco_nxos_nxapi_interfaces_mixed_rows():
+    ifaces = acquire_switches.parse_cisco_nxos_nxapi_interfaces("sw1", json.dumps(NXAPI_INTERFACES))
+    by_name = {iface["switchport"]: iface for iface in ifaces}
+    assert set(by_name) == {"Eth1/1", "Vlan10", "Po4", "mgmt0"}
+
+    assert by_name["Eth1/1"]["description"] == "old"
+    assert by_name["Eth1/1"]["type"] == "100/1000/10000 Ethernet"
+    assert by_name["Eth1/1"]["address"] == "00defbeeab01"
+
+    assert by_name["Vlan10"]["state"] == "up"
+    assert by_name["Vlan10"]["type"] == "EtherSVI"
+    assert by_name["Vlan10"]["description"] == "servers"
+    assert by_name["Vlan10"]["address"] == "00defbeeab00"
+
+    assert by_name["Po4"]["members"] == ["Eth1/4", "Eth1/5"]
+    # every port has a type, format_cisco_nxos reads it
+    assert by_name["mgmt0"]["type"] == ""
+
+
+def test_nxapi_run_commands_optional_error(monkeypatch):
+    replies = [
+        {"jsonrpc": "2.0", "id": 1, "result": {"body": NXAPI_INTERFACES}},
+        {
+            "jsonrpc": "2.0",
+            "id": 2,
+            "error": {"code": -32602, "message": "Invalid params", "data": {"msg": "% Invalid command"}},
+        },
+    ]
+
+    class Response:
+        status = 500
+        reason = "Internal Server Error"
+
+    monkeypatch.setattr(nxapi, "post", lambda device_options, body: (Response(), json.dumps(replies).encode()))
+    commands = ["show interface", "show flogi database"]
+    bodies = nxapi.run_commands("sw1", {}, commands, {"show flogi database"})
+    assert bodies == [NXAPI_INTERFACES, {}]
+
+    try:
+        nxapi.run_commands("sw1", {}, commands)
+    except nxapi.NxapiError as e:
+        assert "show flogi database" in str(e)
+    else:
+        assert False, "a failing command that is not optional must raise"
+
+
+def snmp_hex(text):
+    """An octet string as printed by snmpbulkwalk -Ox, wrapped after 16 octets."""
+    octets = ["%02X" % octet for octet in text.encode()]
+    return '"' + "\n".join(" ".join(octets[i : i + 16]) for i in range(0, len(octets), 16)) + ' "'
+
+
+def test_parse_snmp_lldp_prefers_local_port_id():
+    walk = [
+        # ifName
+        (".1.3.6.1.2.1.31.1.1.1.1.4", snmp_hex("GE1/0/4")),
+        (".1.3.6.1.2.1.31.1.1.1.1.5", snmp_hex("GE1/0/5")),
+        (".1.3.6.1.2.1.31.1.1.1.1.6", snmp_hex("GE1/0/6")),
+        # lldpLocPortIdSubtype, lldpLocPortId: an interface name that differs from ifName, and a MAC address
+        (".1.0.8802.1.1.2.1.3.7.1.2.4", "5"),
+        (".1.0.8802.1.1.2.1.3.7.1.2.5", "3"),
+        (".1.0.8802.1.1.2.1.3.7.1.3.4", snmp_hex("Ten-GigabitEthernet1/0/33")),
+        (".1.0.8802.1.1.2.1.3.7.1.3.5", '"5C 8A 38 28 71 A8 "'),
+        # lldpRemPortIdSubtype, lldpRemPortId, lldpRemSysName, indexed by timeMark.localPortNum.remIndex
+        (".1.0.8802.1.1.2.1.4.1.1.6.0.4.1", "5"),
+        (".1.0.8802.1.1.2.1.4.1.1.6.0.5.2", "3"),
+        (".1.0.8802.1.1.2.1.4.1.1.6.0.6.3", "5"),
+        (".1.0.8802.1.1.2.1.4.1.1.7.0.4.1", snmp_hex("Ethernet1/48")),
+        (".1.0.8802.1.1.2.1.4.1.1.7.0.5.2", '"AC 1F 6B 00 00 01 "'),
+        (".1.0.8802.1.1.2.1.4.1.1.7.0.6.3", snmp_hex("eth0")),
+        (".1.0.8802.1.1.2.1.4.1.1.9.0.4.1", snmp_hex("sw0002.example.com")),
+        (".1.0.8802.1.1.2.1.4.1.1.9.0.5.2", snmp_hex("host1")),
+        (".1.0.8802.1.1.2.1.4.1.1.9.0.6.3", snmp_hex("host2")),
+    ]
+    text = "".join("%s %s\n" % row for row in walk)
+    ifaces = acquire_switches.parse_hp_comware_snmp_lldp("sw1", text)
+    by_host = {iface["hostname"]: iface for iface in ifaces}
+    assert len(ifaces) == 3
+    # lldpLocPortId names the port, not ifName of lldpLocPortNum
+    assert by_host["sw0002.example.com"]["switchport"] == "Ten-GigabitEthernet1/0/33"
+    assert by_host["sw0002.example.com"]["hostport"] == "Ethernet1/48"
+    # a MAC address as local port ID, or none at all: ifName
+    assert by_host["host1"]["switchport"] == "GigabitEthernet1/0/5"
+    assert by_host["host1"]["hostport"] == "ac1f-6b00-0001"
+    assert by_host["host2"]["switchport"] == "GigabitEthernet1/0/6"